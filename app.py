@@ -1,45 +1,251 @@
+import click
 import os
-from flask import Flask, jsonify, abort, request
+from flask import Flask, Response, jsonify, abort, request
+from werkzeug.exceptions import HTTPException
 from models import *
 from flask_cors import CORS
 from flask_migrate import Migrate
-from auth import AuthError, requires_auth
+from sqlalchemy import text
+from sqlalchemy.orm import selectinload
+from auth import AuthError, key_store_ready, requires_auth
+from batch import BatchError, run_batch
+from bulk import bulk_insert
+from compression import compress_response
+from conditional import conditional_get, record_response
+from fields import format_fields, get_fields, select_fields
+from filters import filter_actors, filter_movies
+from metrics import instrument, log_exception, pool_gauges, render_metrics
+from pagination import get_page, paginate
+from pool import pool_metrics
+from ratelimit import limit_concurrency
+from response_cache import cached_response
+from search import get_search, search
+from serialization import execute_rows, fast_jsonify, fast_path_enabled, select_rows
+from stats import catalog_stats, rebuild_stats
+from streaming import get_stream_format, stream_response
+from transfer import TransferError, TransferReport, export_records, get_transfer_format, import_records, open_data, transfer_formats
+from writes import delete_record, get_if_match, update_record
 
 def create_app(test_config=None):
 
     app = Flask(__name__)
+    app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+    app.config['MAX_CONCURRENT_REQUESTS'] = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0))
+    app.config['CONCURRENCY_RETRY_AFTER'] = int(os.environ.get('CONCURRENCY_RETRY_AFTER', 1))
+    if test_config is not None:
+        app.config.update(test_config)
+
+    if app.config['MAX_CONCURRENT_REQUESTS'] > 0:
+        limit_concurrency(app, app.config['MAX_CONCURRENT_REQUESTS'], app.config['CONCURRENCY_RETRY_AFTER'])
+
+    if app.config['METRICS_ENABLED']:
+        instrument(app)
+
     setup_db(app)
     CORS(app)
     migrate = Migrate(app, db)
 
+    @app.cli.command('create-db')
+    def create_db():
+        '''Create any missing tables without migrations, e.g. for a local SQLite database.'''
+        db.create_all()
+
+    @app.cli.command('rebuild-stats')
+    def rebuild_stats_command():
+        '''Recount the statistics served by GET /stats from the actor and movie tables.'''
+        rebuild_stats()
+        db.session.commit()
+
+    transfer_models = {'actors': Actor, 'movies': Movie}
+
+    @app.cli.command('export')
+    @click.argument('resource', type=click.Choice(list(transfer_models)))
+    @click.argument('path', default='-')
+    @click.option('--format', type=click.Choice(transfer_formats), help='Defaults to csv for .csv files, else ndjson.')
+    @click.option('--chunk-size', type=int, help='Rows fetched per round trip.')
+    def export_command(resource, path, format, chunk_size):
+        '''Write every actor or movie to PATH (stdout by default) as CSV or NDJSON.'''
+        report = TransferReport('Exported', resource)
+        with open_data(path, 'w') as out:
+            count = export_records(transfer_models[resource], out, get_transfer_format(path, format), chunk_size, report.progress)
+        report.finish(count)
+
+    @app.cli.command('import')
+    @click.argument('resource', type=click.Choice(list(transfer_models)))
+    @click.argument('path', default='-')
+    @click.option('--format', type=click.Choice(transfer_formats), help='Defaults to csv for .csv files, else ndjson.')
+    @click.option('--upsert', is_flag=True, help='Update records whose id already exists instead of failing.')
+    @click.option('--chunk-size', type=int, help='Rows loaded and committed at a time.')
+    def import_command(resource, path, format, upsert, chunk_size):
+        '''Load actors or movies from a CSV or NDJSON file at PATH (stdin by default).'''
+        report = TransferReport('Imported', resource)
+        with open_data(path, 'r') as lines:
+            try:
+                count, errors = import_records(
+                    transfer_models[resource], lines, get_transfer_format(path, format), upsert, chunk_size, report.progress
+                )
+            except TransferError as e:
+                report.finish(e.imported)
+                raise click.ClickException('a chunk could not be loaded, e.g. an id already exists (see --upsert): ' + e.message)
+
+        for error in errors:
+            click.echo('line {}: {}'.format(error['line'], error['message']), err = True)
+        report.finish(count)
+        if errors:
+            raise click.ClickException('{} invalid records skipped'.format(len(errors)))
+
     @app.after_request
     def after_request(response):
         response.headers.add("Access-Control-Allow-Headers", "Content-Type,Authorization,true")
         response.headers.add("Access-Control-Allow-Methods", "GET,POST,DELETE,OPTIONS")
-        return response
+        return compress_response(response)
 
     @app.route('/')
     def home():
         return jsonify({'success': True}), 200
 
+    @app.route('/health/ready')
+    def ready():
+        '''Whether this worker can serve: the primary database answers and token signing keys are loaded.'''
+        checks = {'database' : 'ok', 'keys' : 'ok'}
+        try:
+            with db.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception as e:
+            app.logger.warning('readiness check: database unavailable: %s', e)
+            checks['database'] = 'unavailable'
+
+        if not key_store_ready():
+            checks['keys'] = 'unavailable'
+
+        ready = all(status == 'ok' for status in checks.values())
+        return jsonify({'success' : ready, **checks}), 200 if ready else 503
+
+    if app.config['METRICS_ENABLED']:
+        def database_pools():
+            pools = {'primary' : pool_metrics(db.engine)}
+            replicas = app.extensions.get('replicas')
+            if replicas is not None:
+                for index, engine in enumerate(replicas.engines):
+                    pools['replica-{}'.format(index)] = pool_metrics(engine)
+            return pools
+
+        @app.route('/metrics/pool')
+        def get_pool_metrics():
+            pools = database_pools()
+            return jsonify({
+                'success' : True,
+                'pool' : pools['primary'],
+                'pools' : pools
+            }), 200
+
+        @app.route('/metrics')
+        def get_metrics():
+            return Response(
+                render_metrics(pool_gauges(database_pools())),
+                mimetype = 'text/plain; version=0.0.4'
+            )
+
     #------ACTORS------
 
     @app.route('/actors')
     @requires_auth('get:actors')
+    @conditional_get(Actor, embeds = {'movies' : (Movie, Casting)})
+    @cached_response('get:actors', Actor, embeds = {'movies' : (Movie, Casting)})
     def get_actors(jwt):
+        search_query = get_search(request.args)
+        page = get_page(request.args) if search_query is None else None
+        stream = get_stream_format(request.args)
+        if stream is not None and (page is not None or search_query is not None):
+            abort(400)
+
+        embed = request.args.get('embed')
+        if embed not in (None, 'movies'):
+            abort(400)
+
+        fields = get_fields(request.args, Actor)
+        if fields is not None and embed is not None:
+            abort(400)
+
+        query = filter_actors(Actor.query, request.args)
+        format_actor = Actor.format
+        if embed is not None:
+            query = query.options(selectinload(Actor.movies))
+            format_actor = Actor.format_with_movies
+        if fields is not None:
+            query = select_fields(query, Actor, fields)
+            format_actor = format_fields(fields)
+
         try:
-            actors = Actor.query.order_by(Actor.id).all()
-            format_actors = [actor.format() for actor in actors]
+            if stream is not None:
+                return stream_response(query, Actor.id, 'actors', stream, format_actor)
 
-            return jsonify({
+            if search_query is not None:
+                actors = search(query, Actor, *search_query)
+
+                return jsonify({
+                    'success' : True,
+                    'actors' : [format_actor(actor) for actor in actors]
+                }), 200
+
+            fast_path = embed is None and fields is None and fast_path_enabled()
+
+            if page is None:
+                if fast_path:
+                    return fast_jsonify('actors', Actor, execute_rows(query, Actor, Actor.id)), 200
+
+                actors = query.order_by(Actor.id).all()
+                format_actors = [format_actor(actor) for actor in actors]
+
+                return jsonify({
+                    'success' : True,
+                    'actors' : format_actors
+                }), 200
+
+            if fast_path:
+                rows, next_cursor, total = paginate(select_rows(query, Actor), Actor.id, page)
+                body = {'next_cursor' : next_cursor}
+                if total is not None:
+                    body['total'] = total
+
+                return fast_jsonify('actors', Actor, rows, **body), 200
+
+            actors, next_cursor, total = paginate(query, Actor.id, page)
+            body = {
                 'success' : True,
-                'actors' : format_actors
-            }), 200
+                'actors' : [format_actor(actor) for actor in actors],
+                'next_cursor' : next_cursor
+            }
+            if total is not None:
+                body['total'] = total
+
+            return jsonify(body), 200
         except Exception as e:
-            print(e)
+            log_exception(e)
             abort(500)
 
 
+    @app.route('/actors/<int:actor_id>')
+    @requires_auth('get:actors')
+    def get_actor(jwt, actor_id):
+        fields = get_fields(request.args, Actor)
+
+        query = Actor.query.filter(Actor.id == actor_id)
+        format_actor = Actor.format
+        if fields is not None:
+            query = select_fields(query, Actor, fields + ['version'])
+            format_actor = format_fields(fields)
+
+        actor = query.first()
+        if actor is None:
+            abort(404)
+
+        return record_response({
+            'success' : True,
+            'actor' : format_actor(actor)
+        }, actor.version)
+
+
     @app.route('/actors', methods = ['POST'])
     @requires_auth('post:actors')
     def create_actor(jwt):
@@ -75,11 +281,31 @@ def create_app(test_config=None):
             db.session.close()
 
 
+    @app.route('/actors/bulk', methods = ['POST'])
+    @requires_auth('post:actors')
+    def create_actors_bulk(jwt):
+        try:
+            created, errors = bulk_insert(Actor, request)
+            db.session.commit()
+
+            return jsonify({
+                'success' : True,
+                'created' : created,
+                'errors' : errors
+            }), 201
+        except HTTPException:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            db.session.rollback()
+            abort(500)
+        finally:
+            db.session.close()
+
     @app.route('/actors/<int:actor_id>', methods = ['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(jwt, actor_id):
-        actor = Actor.query.get_or_404(actor_id)
-
         new_actor = request.get_json()
 
         name = new_actor.get("name", None)
@@ -90,19 +316,23 @@ def create_app(test_config=None):
             abort(400)
 
         try:
-            actor.name = name
-            actor.age = age
-            actor.gender = gender
-            actor.update()
+            actor = update_record(Actor, actor_id, {'name' : name, 'age' : age, 'gender' : gender}, get_if_match())
+            db.session.commit()
 
-            return jsonify ({
+            response = jsonify ({
                 'success' : True,
-                'name' : name,
-                'age' : age,
-                'gender' : gender
-             }), 201
+                'name' : actor.name,
+                'age' : actor.age,
+                'gender' : actor.gender,
+                'version' : actor.version
+             })
+            response.set_etag(str(actor.version))
+            return response, 201
+        except HTTPException:
+            db.session.rollback()
+            raise
         except Exception as e:
-            print(e)
+            log_exception(e)
             db.session.rollback()
             abort(500)
         finally:
@@ -111,37 +341,124 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods = ['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(jwt, actor_id):
-        actor = Actor.query.get_or_404(actor_id)
-
         try:
-            actor.delete()
+            actor = delete_record(Actor, actor_id, get_if_match(), Actor.name)
+            db.session.commit()
 
             return jsonify({
                 "success" : True,
                 "name" : actor.name,
                 "deleted" : actor_id
             }), 201
-        except:
+        except HTTPException:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            db.session.rollback()
             abort (422)
+        finally:
+            db.session.close()
 
 
     #------MOVIES------
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @conditional_get(Movie, embeds = {'cast' : (Actor, Casting)})
+    @cached_response('get:movies', Movie, embeds = {'cast' : (Actor, Casting)})
     def get_movies(jwt):
+        search_query = get_search(request.args)
+        page = get_page(request.args) if search_query is None else None
+        stream = get_stream_format(request.args)
+        if stream is not None and (page is not None or search_query is not None):
+            abort(400)
+
+        embed = request.args.get('embed')
+        if embed not in (None, 'cast'):
+            abort(400)
+
+        fields = get_fields(request.args, Movie)
+        if fields is not None and embed is not None:
+            abort(400)
+
+        query = filter_movies(Movie.query, request.args)
+        format_movie = Movie.format
+        if embed is not None:
+            query = query.options(selectinload(Movie.actors))
+            format_movie = Movie.format_with_cast
+        if fields is not None:
+            query = select_fields(query, Movie, fields)
+            format_movie = format_fields(fields)
+
         try:
-            movies = Movie.query.order_by(Movie.id).all()
-            format_movies = [movie.format() for movie in movies]
+            if stream is not None:
+                return stream_response(query, Movie.id, 'movies', stream, format_movie)
 
-            return jsonify({
+            if search_query is not None:
+                movies = search(query, Movie, *search_query)
+
+                return jsonify({
+                    'success' : True,
+                    'movies' : [format_movie(movie) for movie in movies]
+                }), 200
+
+            fast_path = embed is None and fields is None and fast_path_enabled()
+
+            if page is None:
+                if fast_path:
+                    return fast_jsonify('movies', Movie, execute_rows(query, Movie, Movie.id)), 200
+
+                movies = query.order_by(Movie.id).all()
+                format_movies = [format_movie(movie) for movie in movies]
+
+                return jsonify({
+                    'success' : True,
+                    'movies' : format_movies
+                }), 200
+
+            if fast_path:
+                rows, next_cursor, total = paginate(select_rows(query, Movie), Movie.id, page)
+                body = {'next_cursor' : next_cursor}
+                if total is not None:
+                    body['total'] = total
+
+                return fast_jsonify('movies', Movie, rows, **body), 200
+
+            movies, next_cursor, total = paginate(query, Movie.id, page)
+            body = {
                 'success' : True,
-                'movies' : format_movies
-            }), 200
+                'movies' : [format_movie(movie) for movie in movies],
+                'next_cursor' : next_cursor
+            }
+            if total is not None:
+                body['total'] = total
+
+            return jsonify(body), 200
         except Exception as e:
-            print(e)
+            log_exception(e)
             abort(500)
 
+    @app.route('/movies/<int:movie_id>')
+    @requires_auth('get:movies')
+    def get_movie(jwt, movie_id):
+        fields = get_fields(request.args, Movie)
+
+        query = Movie.query.filter(Movie.id == movie_id)
+        format_movie = Movie.format
+        if fields is not None:
+            query = select_fields(query, Movie, fields + ['version'])
+            format_movie = format_fields(fields)
+
+        movie = query.first()
+        if movie is None:
+            abort(404)
+
+        return record_response({
+            'success' : True,
+            'movie' : format_movie(movie)
+        }, movie.version)
+
     @app.route('/movies', methods = ['POST'])
     @requires_auth('post:movies')
     def create_movie(jwt):
@@ -172,11 +489,31 @@ def create_app(test_config=None):
         finally: 
             db.session.close()
 
+    @app.route('/movies/bulk', methods = ['POST'])
+    @requires_auth('post:movies')
+    def create_movies_bulk(jwt):
+        try:
+            created, errors = bulk_insert(Movie, request)
+            db.session.commit()
+
+            return jsonify({
+                'success' : True,
+                'created' : created,
+                'errors' : errors
+            }), 201
+        except HTTPException:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            db.session.rollback()
+            abort(500)
+        finally:
+            db.session.close()
+
     @app.route('/movies/<int:movie_id>', methods = ['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(jwt, movie_id):
-        movie = Movie.query.get_or_404(movie_id)
-
         new_movie = request.get_json()
 
         title = new_movie.get("title", None)
@@ -186,16 +523,22 @@ def create_app(test_config=None):
             abort(400)
 
         try:
-            movie.title = title
-            movie.release_date = release_date
-            movie.update()
+            movie = update_record(Movie, movie_id, {'title' : title, 'release_date' : release_date}, get_if_match())
+            db.session.commit()
 
-            return jsonify ({
+            response = jsonify ({
                 'success' : True,
-                'title' : title,
-                'release_date' : release_date
-             }), 201
+                'title' : movie.title,
+                'release_date' : movie.release_date,
+                'version' : movie.version
+             })
+            response.set_etag(str(movie.version))
+            return response, 201
+        except HTTPException:
+            db.session.rollback()
+            raise
         except Exception as e:
+            log_exception(e)
             db.session.rollback()
             abort(500)
         finally:
@@ -204,24 +547,203 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods = ['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(jwt, movie_id):
-        movie = Movie.query.get_or_404(movie_id)
-
         try:
-            movie.delete()
+            movie = delete_record(Movie, movie_id, get_if_match(), Movie.title)
+            db.session.commit()
 
             return jsonify({
                 "success" : True,
                 "title" : movie.title,
                 "deleted" : movie_id
             }), 201
+        except HTTPException:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            db.session.rollback()
+            abort (422)
+        finally:
+            db.session.close()
+
+
+    #------SEARCH------
+
+    @app.route('/search')
+    @requires_auth()
+    @conditional_get(Actor, Movie)
+    def search_catalog(jwt):
+        search_query = get_search(request.args)
+        if search_query is None:
+            abort(400)
+
+        permissions = jwt.get('permissions', [])
+        if 'get:actors' not in permissions and 'get:movies' not in permissions:
+            raise AuthError({
+                "code" : "unauthorized",
+                "description" : "Permission not found."
+            }, 403)
+
+        try:
+            body = {'success' : True}
+            if 'get:actors' in permissions:
+                body['actors'] = [actor.format() for actor in search(Actor.query, Actor, *search_query)]
+            if 'get:movies' in permissions:
+                body['movies'] = [movie.format() for movie in search(Movie.query, Movie, *search_query)]
+
+            return jsonify(body), 200
+        except Exception as e:
+            log_exception(e)
+            abort(500)
+
+
+    #------STATISTICS------
+
+    @app.route('/stats')
+    @requires_auth()
+    @conditional_get(Actor, Movie, CatalogStat)
+    def get_stats(jwt):
+        permissions = jwt.get('permissions', [])
+        if 'get:actors' not in permissions and 'get:movies' not in permissions:
+            raise AuthError({
+                "code" : "unauthorized",
+                "description" : "Permission not found."
+            }, 403)
+
+        try:
+            body = catalog_stats('get:actors' in permissions, 'get:movies' in permissions)
+            return jsonify({'success' : True, **body}), 200
+        except Exception as e:
+            log_exception(e)
+            abort(500)
+
+
+    #------CASTING------
+
+    @app.route('/movies/<int:movie_id>/cast')
+    @requires_auth('get:movies')
+    @conditional_get(Movie, Actor, Casting)
+    def get_movie_cast(jwt, movie_id):
+        Movie.query.get_or_404(movie_id)
+
+        try:
+            actors = Actor.query.join(Casting).filter(Casting.movie_id == movie_id).order_by(Actor.id).all()
+
+            return jsonify({
+                'success' : True,
+                'movie_id' : movie_id,
+                'cast' : [actor.format() for actor in actors]
+            }), 200
+        except Exception as e:
+            log_exception(e)
+            abort(500)
+
+    @app.route('/actors/<int:actor_id>/movies')
+    @requires_auth('get:actors')
+    @conditional_get(Actor, Movie, Casting)
+    def get_actor_movies(jwt, actor_id):
+        Actor.query.get_or_404(actor_id)
+
+        try:
+            movies = Movie.query.join(Casting).filter(Casting.actor_id == actor_id).order_by(Movie.id).all()
+
+            return jsonify({
+                'success' : True,
+                'actor_id' : actor_id,
+                'movies' : [movie.format() for movie in movies]
+            }), 200
+        except Exception as e:
+            log_exception(e)
+            abort(500)
+
+    @app.route('/movies/<int:movie_id>/cast', methods = ['POST'])
+    @requires_auth('patch:movies')
+    def create_casting(jwt, movie_id):
+        Movie.query.get_or_404(movie_id)
+
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get('actor_id'), int):
+            abort(400)
+
+        actor_id = body['actor_id']
+        Actor.query.get_or_404(actor_id)
+
+        if Casting.query.get((movie_id, actor_id)) is not None:
+            abort(422)
+
+        try:
+            casting = Casting(movie_id = movie_id, actor_id = actor_id)
+            casting.insert()
+
+            return jsonify({
+                'success' : True,
+                'movie_id' : movie_id,
+                'actor_id' : actor_id
+            }), 201
+        except:
+            db.session.rollback()
+            abort(500)
+        finally:
+            db.session.close()
+
+    @app.route('/movies/<int:movie_id>/cast/<int:actor_id>', methods = ['DELETE'])
+    @requires_auth('patch:movies')
+    def delete_casting(jwt, movie_id, actor_id):
+        casting = Casting.query.get_or_404((movie_id, actor_id))
+
+        try:
+            casting.delete()
+
+            return jsonify({
+                'success' : True,
+                'movie_id' : movie_id,
+                'deleted' : actor_id
+            }), 201
         except:
             abort (422)
 
 
+    #------BATCH------
+
+    @app.route('/batch', methods = ['POST'])
+    @requires_auth()
+    def batch(jwt):
+        try:
+            results = run_batch(request.get_json(silent=True), jwt)
+            db.session.commit()
+
+            return jsonify({
+                'success' : True,
+                'results' : results
+            }), 200
+        except BatchError as e:
+            db.session.rollback()
+            return jsonify({
+                'success' : False,
+                'error' : e.status_code,
+                'message' : e.message,
+                'index' : e.index
+            }), e.status_code
+        except AuthError:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            db.session.rollback()
+            abort(500)
+        finally:
+            db.session.close()
+
+
 
 
 #------ERROR FORMATTING------
 
+    def retry_after_header(error):
+        if error.retry_after is None:
+            return {}
+        return {'Retry-After' : str(error.retry_after)}
+
     @app.errorhandler(400)
     def bad_request(error):
         return (
@@ -251,6 +773,16 @@ def create_app(test_config=None):
             }),
             404)
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return (
+            jsonify({
+                'error' : 412,
+                'success' : False,
+                'message' : 'the resource has changed, fetch it again'
+            }),
+            412)
+
     @app.errorhandler(422)
     def unprocessable(error):
         return (
@@ -261,6 +793,17 @@ def create_app(test_config=None):
             }),
             422)
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return (
+            jsonify({
+                'error' : 429,
+                'success' : False,
+                'message' : 'too many requests'
+            }),
+            429,
+            retry_after_header(error))
+
     @app.errorhandler(500)
     def unprocessable(error):
         return (
@@ -271,6 +814,17 @@ def create_app(test_config=None):
             }),
             500)
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return (
+            jsonify({
+                'error' : 503,
+                'success' : False,
+                'message' : 'service unavailable, try again later'
+            }),
+            503,
+            retry_after_header(error))
+
     @app.errorhandler(AuthError)
     def auth_error(error):
         return jsonify({
@@ -281,7 +835,26 @@ def create_app(test_config=None):
 
     return app
 
-app = create_app()
+
+_app = None
+
+'''
+app
+    the application served by `gunicorn app:app` and `flask run`
+
+    Built by create_app() on first access rather than at import, so importing
+    this module (tests, CLI tools, workers that import before forking) stays
+    free of configuration and database work.
+'''
+def __getattr__(name):
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
+
@@ -0,0 +1,697 @@
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import abort, g, jsonify, make_response, request
+from sqlalchemy import func, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import HTTPException
+from werkzeug.routing import Map, Rule
+from werkzeug.urls import url_decode
+from app import create_app
+from auth import requires_auth_async
+from conditional import record_response, versions_etag
+from fields import field_columns, format_fields, get_fields
+from filters import filter_actors, filter_movies
+from metrics import log_exception
+from models import Actor, Casting, Movie, TableVersion, bump_table_versions
+from pagination import encode_cursor, get_page
+from pool import engine_options
+from serialization import fast_jsonify, fast_path_enabled, row_encoder
+from writes import casting_delete_statement, delete_statement, exists_statement, get_if_match, update_statement
+
+async_database_url = os.environ.get('ASYNC_DATABASE_URL')
+asgi_wsgi_threads = int(os.environ.get('ASGI_WSGI_THREADS', 8))
+
+# async driver used for each database the app runs on
+async_drivers = {
+    'sqlite' : 'sqlite+aiosqlite',
+    'postgres' : 'postgresql+asyncpg',
+    'postgresql' : 'postgresql+asyncpg'
+}
+
+
+def async_database_uri(database_uri):
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    if backend not in async_drivers:
+        raise ValueError('no async driver for {} databases'.format(backend))
+    return url.set(drivername = async_drivers[backend])
+
+
+'''
+wsgi_environ(scope, body)
+    the WSGI environ of an ASGI http request whose body has been read
+'''
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD' : scope['method'],
+        'SCRIPT_NAME' : scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO' : scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING' : scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME' : server[0],
+        'SERVER_PORT' : str(server[1]),
+        'SERVER_PROTOCOL' : 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version' : (1, 0),
+        'wsgi.url_scheme' : scope.get('scheme', 'http'),
+        'wsgi.input' : io.BytesIO(body),
+        'wsgi.errors' : sys.stderr,
+        'wsgi.multithread' : True,
+        'wsgi.multiprocess' : True,
+        'wsgi.run_once' : False
+    }
+
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+
+    # the body is already buffered, whatever its transfer encoding was
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+
+    return environ
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return bytes(body)
+
+
+async def send_response(response, environ, send):
+    body, status, headers = response.get_wsgi_response(environ)
+    await send({
+        'type' : 'http.response.start',
+        'status' : response.status_code,
+        'headers' : [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    })
+    try:
+        for chunk in body:
+            if chunk:
+                await send({'type' : 'http.response.body', 'body' : chunk, 'more_body' : True})
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    await send({'type' : 'http.response.body', 'body' : b''})
+
+
+class ClientGone(Exception):
+    pass
+
+
+'''
+AsyncApp
+    ASGI application serving the routes of a Flask app built by create_app
+
+    Routes registered with route() run as coroutines on the event loop, inside
+    the Flask app's request context so that request, abort, jsonify, the error
+    handlers and the after_request hooks (CORS, compression) behave as under
+    WSGI. Their queries go through an AsyncSession, available as
+    g.async_session. Every other request, and requests to an async route
+    carrying one of its fallback_args, are handed to the Flask app itself on a
+    pool of ASGI_WSGI_THREADS threads.
+'''
+class AsyncApp:
+
+    def __init__(self, app):
+        self.app = app
+        self.url_map = Map()
+        self.views = {}
+        self.fallback_args = {}
+
+        database_uri = async_database_url or async_database_uri(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.engine = create_async_engine(database_uri, **engine_options(database_uri))
+        self.session = sessionmaker(self.engine, class_ = AsyncSession, expire_on_commit = False)
+        self.executor = ThreadPoolExecutor(max_workers = asgi_wsgi_threads, thread_name_prefix = 'wsgi')
+        self.connected = False
+        self.connect_lock = asyncio.Lock()
+
+    def route(self, rule, methods=('GET',), fallback_args=()):
+        def route_decorator(f):
+            self.url_map.add(Rule(rule, methods = methods, endpoint = f.__name__))
+            self.views[f.__name__] = f
+            self.fallback_args[f.__name__] = fallback_args
+            return f
+        return route_decorator
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('unsupported ASGI scope type {}'.format(scope['type']))
+
+        environ = wsgi_environ(scope, await read_body(receive))
+
+        try:
+            endpoint, view_args = self.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return await self.call_wsgi(environ, send)
+
+        args = url_decode(environ['QUERY_STRING'])
+        if any(arg in args for arg in self.fallback_args[endpoint]):
+            return await self.call_wsgi(environ, send)
+
+        response = await self.dispatch(environ, endpoint, view_args)
+        await send_response(response, environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type' : 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type' : 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        await self.engine.dispose()
+        self.executor.shutdown(wait = False)
+
+    '''
+    connect_once()
+        opens the engine's first connection on its own
+
+        SQLAlchemy runs its first-connect setup under a thread lock, which
+        deadlocks the event loop if a second coroutine connects meanwhile.
+    '''
+    async def connect_once(self):
+        if self.connected:
+            return
+        async with self.connect_lock:
+            if not self.connected:
+                async with self.engine.connect():
+                    pass
+                self.connected = True
+
+    '''
+    dispatch(environ, endpoint, view_args)
+        runs an async view the way Flask's wsgi_app runs a view
+    '''
+    async def dispatch(self, environ, endpoint, view_args):
+        app = self.app
+        with app.request_context(environ):
+            async with self.session() as session:
+                g.async_session = session
+                try:
+                    try:
+                        rv = app.preprocess_request()
+                        if rv is None:
+                            await self.connect_once()
+                            rv = await self.views[endpoint](**view_args)
+                    except Exception as e:
+                        rv = app.handle_user_exception(e)
+                    return app.finalize_request(rv)
+                except Exception as e:
+                    return app.handle_exception(e)
+
+    '''
+    call_wsgi(environ, send)
+        serves a request with the Flask app on the thread pool
+
+        The response is relayed chunk by chunk as the app produces it, so
+        streamed responses stay streamed. At most a few chunks are queued
+        ahead of the client.
+    '''
+    async def call_wsgi(self, environ, send):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize = 4)
+        gone = threading.Event()
+        done = object()
+
+        def put(message):
+            if gone.is_set():
+                raise ClientGone()
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        worker = loop.run_in_executor(self.executor, self.run_wsgi, environ, put, done)
+        try:
+            while True:
+                message = await queue.get()
+                if message is done:
+                    break
+                await send(message)
+        finally:
+            gone.set()
+            while not queue.empty():
+                queue.get_nowait()
+            await worker
+
+    def run_wsgi(self, environ, put, done):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+
+        try:
+            body = self.app(environ, start_response)
+            try:
+                status, headers = started
+                put({
+                    'type' : 'http.response.start',
+                    'status' : status,
+                    'headers' : [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+                })
+                for chunk in body:
+                    if chunk:
+                        put({'type' : 'http.response.body', 'body' : chunk, 'more_body' : True})
+                put({'type' : 'http.response.body', 'body' : b''})
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+        except ClientGone:
+            pass
+        finally:
+            try:
+                put(done)
+            except ClientGone:
+                pass
+
+
+async def async_table_etag(session, *models):
+    names = [model.__tablename__ for model in models]
+    table = TableVersion.__table__
+    rows = await session.execute(
+        select(table.c.name, table.c.version).where(table.c.name.in_(names))
+    )
+    versions = dict.fromkeys(names, 0)
+    versions.update(rows.all())
+    return versions_etag(names, versions)
+
+
+'''
+conditional_get_async(*models)
+    conditional_get for async views: a weak ETag from the tables' versions,
+    and 304 Not Modified while If-None-Match still matches
+'''
+def conditional_get_async(*models):
+    def conditional_get_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            etag = g.table_etag = await async_table_etag(g.async_session, *models)
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag, weak=True)
+                return response
+
+            response = make_response(await f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+            return response
+        return wrapper
+    return conditional_get_decorator
+
+
+'''
+select_columns(model, fields)
+    a Core select of the columns a read response is built from
+
+    The requested fields when given, else every column: sorted for
+    fast_jsonify when the fast path is on, in table order otherwise.
+'''
+def select_columns(model, fields):
+    if fields is not None:
+        return select(*field_columns(model, fields))
+    if fast_path_enabled():
+        return select(*row_encoder(model).columns)
+    return select(*model.__table__.columns)
+
+
+def format_row(fields):
+    if fields is not None:
+        return format_fields(fields)
+    return lambda row: dict(row._mapping)
+
+
+async def paginate_async(session, query, column, page):
+    total = None
+    if page.with_total:
+        total = await session.scalar(select(func.count()).select_from(query.subquery()))
+
+    if page.after is not None:
+        query = query.filter(column > page.after)
+
+    rows = (await session.execute(query.order_by(column).limit(page.limit + 1))).all()
+
+    next_cursor = None
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        next_cursor = encode_cursor(getattr(rows[-1], column.key))
+
+    return rows, next_cursor, total
+
+
+async def list_response(query, model, key, page, fields):
+    session = g.async_session
+    body = {}
+    if page is None:
+        rows = (await session.execute(query.order_by(model.id))).all()
+    else:
+        rows, next_cursor, total = await paginate_async(session, query, model.id, page)
+        body['next_cursor'] = next_cursor
+        if total is not None:
+            body['total'] = total
+
+    if fields is None and fast_path_enabled():
+        return fast_jsonify(key, model, rows, **body), 200
+
+    format_model = format_row(fields)
+    return jsonify({
+        'success' : True,
+        key : [format_model(row) for row in rows],
+        **body
+    }), 200
+
+
+async def detail_response(model, key, id):
+    fields = get_fields(request.args, model)
+    columns = select_columns(model, None if fields is None else fields + ['version'])
+    row = (await g.async_session.execute(columns.where(model.id == id))).first()
+    if row is None:
+        abort(404)
+
+    return record_response({
+        'success' : True,
+        key : format_row(fields)(row)
+    }, row.version)
+
+
+async def abort_missing(session, model, id, versions):
+    if versions is not None and (await session.execute(exists_statement(model, id))).first() is not None:
+        abort(412)
+    abort(404)
+
+
+'''
+update_record(session, model, id, values, versions)
+    writes.update_record for the async session
+'''
+async def update_record(session, model, id, values, versions=None):
+    table = model.__table__
+    statement = update_statement(model, id, values, versions)
+
+    if session.bind.dialect.full_returning:
+        row = (await session.execute(statement.returning(*table.columns))).first()
+    elif (await session.execute(statement)).rowcount:
+        row = (await session.execute(table.select().where(table.c.id == id))).first()
+    else:
+        row = None
+
+    if row is None:
+        await abort_missing(session, model, id, versions)
+    return row
+
+
+'''
+delete_record(session, model, id, versions, *columns)
+    writes.delete_record for the async session
+'''
+async def delete_record(session, model, id, versions, *columns):
+    statement = delete_statement(model, id, versions)
+
+    if session.bind.dialect.full_returning:
+        row = (await session.execute(statement.returning(*columns))).first()
+    else:
+        row = (await session.execute(select(*columns).where(model.__table__.c.id == id))).first()
+        if row is not None and (await session.execute(statement)).rowcount:
+            await session.execute(casting_delete_statement(model, id))
+        else:
+            row = None
+
+    if row is None:
+        await abort_missing(session, model, id, versions)
+    return row
+
+
+'''
+commit(session, *models)
+    commits session, bumping the version of the tables of models in the same
+    transaction as the WSGI app's session does for every write
+'''
+async def commit(session, *models):
+    await session.flush()
+    await session.run_sync(bump_table_versions, [model.__tablename__ for model in models])
+    await session.commit()
+
+
+'''
+create_asgi_app(test_config)
+    the ASGI application: the app of create_app(test_config), with the actor
+    and movie reads and writes served by coroutines over SQLAlchemy's asyncio
+    extension
+'''
+def create_asgi_app(test_config=None):
+
+    asgi = AsyncApp(create_app(test_config))
+
+    @asgi.route('/')
+    async def home():
+        return jsonify({'success': True}), 200
+
+    #------ACTORS------
+
+    @asgi.route('/actors', fallback_args = ('q', 'stream', 'embed'))
+    @requires_auth_async('get:actors')
+    @conditional_get_async(Actor)
+    async def get_actors(jwt):
+        page = get_page(request.args)
+        fields = get_fields(request.args, Actor)
+        query = filter_actors(select_columns(Actor, fields), request.args)
+
+        try:
+            return await list_response(query, Actor, 'actors', page, fields)
+        except Exception as e:
+            log_exception(e)
+            abort(500)
+
+    @asgi.route('/actors/<int:actor_id>')
+    @requires_auth_async('get:actors')
+    async def get_actor(jwt, actor_id):
+        return await detail_response(Actor, 'actor', actor_id)
+
+    @asgi.route('/actors', methods = ['POST'])
+    @requires_auth_async('post:actors')
+    async def create_actor(jwt):
+        actor = request.get_json()
+
+        if "name" not in actor or "age" not in actor or "gender" not in actor:
+            abort(400)
+
+        session = g.async_session
+        try:
+            name = actor.get("name")
+            age = actor.get("age")
+            gender = actor.get("gender")
+
+            session.add(Actor(
+                name = name,
+                age = age,
+                gender = gender
+            ))
+            await commit(session, Actor)
+
+            return jsonify ({
+                'success' : True,
+                'name' : name,
+                'age' : age,
+                'gender' : gender
+             }), 201
+        except Exception as e:
+            log_exception(e)
+            await session.rollback()
+            abort(500)
+
+    @asgi.route('/actors/<int:actor_id>', methods = ['PATCH'])
+    @requires_auth_async('patch:actors')
+    async def update_actor(jwt, actor_id):
+        session = g.async_session
+        new_actor = request.get_json()
+
+        name = new_actor.get("name", None)
+        age = new_actor.get("age", None)
+        gender = new_actor.get("gender", None)
+
+        if name is None or age is None or gender is None:
+            abort(400)
+
+        try:
+            actor = await update_record(session, Actor, actor_id, {'name' : name, 'age' : age, 'gender' : gender}, get_if_match())
+            await commit(session, Actor)
+
+            response = jsonify ({
+                'success' : True,
+                'name' : actor.name,
+                'age' : actor.age,
+                'gender' : actor.gender,
+                'version' : actor.version
+             })
+            response.set_etag(str(actor.version))
+            return response, 201
+        except HTTPException:
+            await session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            await session.rollback()
+            abort(500)
+
+    @asgi.route('/actors/<int:actor_id>', methods = ['DELETE'])
+    @requires_auth_async('delete:actors')
+    async def delete_actor(jwt, actor_id):
+        session = g.async_session
+        try:
+            actor = await delete_record(session, Actor, actor_id, get_if_match(), Actor.name)
+            await commit(session, Actor, Casting)
+
+            return jsonify({
+                "success" : True,
+                "name" : actor.name,
+                "deleted" : actor_id
+            }), 201
+        except HTTPException:
+            await session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            abort (422)
+
+    #------MOVIES------
+
+    @asgi.route('/movies', fallback_args = ('q', 'stream', 'embed'))
+    @requires_auth_async('get:movies')
+    @conditional_get_async(Movie)
+    async def get_movies(jwt):
+        page = get_page(request.args)
+        fields = get_fields(request.args, Movie)
+        query = filter_movies(select_columns(Movie, fields), request.args)
+
+        try:
+            return await list_response(query, Movie, 'movies', page, fields)
+        except Exception as e:
+            log_exception(e)
+            abort(500)
+
+    @asgi.route('/movies/<int:movie_id>')
+    @requires_auth_async('get:movies')
+    async def get_movie(jwt, movie_id):
+        return await detail_response(Movie, 'movie', movie_id)
+
+    @asgi.route('/movies', methods = ['POST'])
+    @requires_auth_async('post:movies')
+    async def create_movie(jwt):
+        movie = request.get_json()
+
+        if "title" not in movie or "release_date" not in movie:
+            abort(400)
+
+        session = g.async_session
+        try:
+            title = movie.get("title")
+            release_date = movie.get("release_date")
+
+            session.add(Movie(
+                title = title,
+                release_date = release_date
+            ))
+            await commit(session, Movie)
+
+            return jsonify ({
+                'success' : True,
+                'title' : title,
+                'release_date' : release_date
+             }), 201
+        except Exception as e:
+            log_exception(e)
+            await session.rollback()
+            abort(500)
+
+    @asgi.route('/movies/<int:movie_id>', methods = ['PATCH'])
+    @requires_auth_async('patch:movies')
+    async def update_movie(jwt, movie_id):
+        session = g.async_session
+        new_movie = request.get_json()
+
+        title = new_movie.get("title", None)
+        release_date = new_movie.get("release_date", None)
+
+        if title is None or release_date is None:
+            abort(400)
+
+        try:
+            movie = await update_record(session, Movie, movie_id, {'title' : title, 'release_date' : release_date}, get_if_match())
+            await commit(session, Movie)
+
+            response = jsonify ({
+                'success' : True,
+                'title' : movie.title,
+                'release_date' : movie.release_date,
+                'version' : movie.version
+             })
+            response.set_etag(str(movie.version))
+            return response, 201
+        except HTTPException:
+            await session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            await session.rollback()
+            abort(500)
+
+    @asgi.route('/movies/<int:movie_id>', methods = ['DELETE'])
+    @requires_auth_async('delete:movies')
+    async def delete_movie(jwt, movie_id):
+        session = g.async_session
+        try:
+            movie = await delete_record(session, Movie, movie_id, get_if_match(), Movie.title)
+            await commit(session, Movie, Casting)
+
+            return jsonify({
+                "success" : True,
+                "title" : movie.title,
+                "deleted" : movie_id
+            }), 201
+        except HTTPException:
+            await session.rollback()
+            raise
+        except Exception as e:
+            log_exception(e)
+            abort (422)
+
+    return asgi
+
+
+_app = None
+
+'''
+app
+    the application served by `uvicorn asgi:app`, built on first access
+'''
+def __getattr__(name):
+    global _app
+    if name == 'app':
+        if _app is None:
+            _app = create_asgi_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
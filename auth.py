@@ -1,9 +1,17 @@
 from email import header
+import asyncio
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from flask import request, abort
 from functools import wraps
 from jose import jwt
+from metrics import auth_verify_duration, cache_lookups
+from ratelimit import rate_limiter
 from urllib.request import urlopen
 
 
@@ -11,6 +19,16 @@ auth_domain = os.environ.get('AUTH0_DOMAIN')
 algorithms = os.environ.get('ALGORITHMS')
 api_audience = os.environ.get('API_AUDIENCE')
 
+jwks_path = os.environ.get('JWKS_PATH')
+jwks_ttl = float(os.environ.get('JWKS_TTL', 3600))
+jwks_min_refresh_interval = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+jwks_timeout = float(os.environ.get('JWKS_TIMEOUT', 5))
+
+token_cache_size = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+token_cache_ttl = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+
+logger = logging.getLogger(__name__)
+
 class AuthError(Exception):
     def __init__(self, error, status_code):
         self.error = error
@@ -41,14 +59,17 @@ def get_token_auth_header():
     token = header_split[1]
     return token
 
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, permissions=None):
     if 'permissions' not in payload:
         raise AuthError({
             "code" : "invalid_claims",
             "description" : "Permissions not in JWT."
         }, 400)
 
-    if permission not in payload['permissions']:
+    if permissions is None:
+        permissions = payload['permissions']
+
+    if permission not in permissions:
         raise AuthError({
             "code" : "unauthorized",
             "description" : "Permission not found."
@@ -57,28 +78,134 @@ def check_permissions(permission, payload):
     return True
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{auth_domain}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+'''
+JWKSKeyStore
+    process-wide cache of the signing keys published by the identity provider
+
+    Keys are indexed by kid and kept for ttl seconds. Once stale they are
+    refreshed on a background thread while the cached keys keep being served.
+    A token signed with an unknown kid triggers a synchronous re-fetch, at most
+    once every min_refresh_interval seconds. The first fetch is rate-limited
+    the same way; until it succeeds, tokens are refused immediately. When
+    path is set the keys are read from that local file and the network is
+    never touched. ready() tells whether there are keys to verify tokens
+    with, fetching them only if they never were.
+'''
+class JWKSKeyStore:
+
+    key_fields = ("kty", "kid", "use", "n", "e")
+
+    def __init__(self, url=None, path=None, ttl=3600, min_refresh_interval=30, timeout=5):
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        if self.path:
+            with open(self.path) as jwks_file:
+                return json.load(jwks_file)
+
+        jsonurl = urlopen(self.url, timeout = self.timeout)
+        return json.loads(jsonurl.read())
+
+    def refresh(self):
+        self._last_attempt = time.monotonic()
+        jwks = self._load()
+
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' in key:
+                keys[key['kid']] = {
+                    field : key[field] for field in self.key_fields if field in key
+                }
+
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return keys
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            logger.warning('background JWKS refresh failed: %s', e)
+        finally:
+            self._refreshing = False
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
 
+        thread = threading.Thread(target = self._background_refresh, daemon = True)
+        thread.start()
+
+    def may_refresh(self, now):
+        return self._last_attempt is None or now - self._last_attempt >= self.min_refresh_interval
+
+    def get_key(self, kid):
+        now = time.monotonic()
+
+        if self._fetched_at is None:
+            if not self.may_refresh(now):
+                return None
+            self.refresh()
+        elif now - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and self.may_refresh(now):
+            key = self.refresh().get(kid)
+
+        return key
+
+    def ready(self):
+        now = time.monotonic()
+
+        if self._fetched_at is None:
+            if self.may_refresh(now):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.warning('JWKS fetch for the readiness check failed: %s', e)
+        elif now - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        return bool(self._keys)
+
+
+key_store = JWKSKeyStore(
+    url = f'https://{auth_domain}/.well-known/jwks.json',
+    path = jwks_path,
+    ttl = jwks_ttl,
+    min_refresh_interval = jwks_min_refresh_interval,
+    timeout = jwks_timeout
+)
+
+
+def key_store_ready():
+    return key_store.ready()
+
+
+@auth_verify_duration.timed
+def verify_decode_jwt(token):
     unverified_header = jwt.get_unverified_header(token)
 
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code' : "invalid_header",
             'description' : "Authorization malformed"
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                "kty" : key["kty"],
-                "kid" : key["kid"],
-                "use" : key["use"],
-                "n" : key["n"],
-                "e" : key["e"]
-            }
+    rsa_key = key_store.get_key(unverified_header['kid'])
 
     if rsa_key:
         try:
@@ -115,18 +242,148 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions', 'expires_at'])
+
+
+'''
+TokenCache
+    bounded LRU cache of verified token payloads
+
+    Entries are keyed by a SHA-256 digest of the raw token and hold the decoded
+    payload alongside a frozenset of its permissions. An entry lives for at
+    most ttl seconds and never past the token's own exp claim. A maxsize of 0
+    disables caching. Hits and misses are counted in cache_lookups_total.
+'''
+class TokenCache:
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= time.time():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                cache_lookups.inc(cache = 'token', result = 'miss')
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            cache_lookups.inc(cache = 'token', result = 'hit')
+            return entry
+
+    def put(self, token, payload):
+        expires_at = time.time() + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        permissions = None
+        if 'permissions' in payload:
+            permissions = frozenset(payload['permissions'])
+
+        entry = VerifiedToken(payload, permissions, expires_at)
+        if self.maxsize <= 0:
+            return entry
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last = False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "size" : len(self._entries),
+            "maxsize" : self.maxsize
+        }
+
+
+token_cache = TokenCache(maxsize = token_cache_size, ttl = token_cache_ttl)
+
+
+'''
+requires_auth(permission)
+    verifies the bearer token and checks it grants permission
+
+    With an empty permission only the token is verified, for routes that check
+    permissions themselves. Then counts the request against the rate limit of
+    the token's subject for permission, answering 429 once it is spent.
+'''
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             jwt = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(jwt)
-            except:
-                abort (401)
+            verified = token_cache.get(jwt)
+            if verified is None:
+                try:
+                    payload = verify_decode_jwt(jwt)
+                except:
+                    abort (401)
+                verified = token_cache.put(jwt, payload)
+
+            if permission:
+                check_permissions(permission, verified.payload, verified.permissions)
+
+            rate_limiter.check(verified.payload.get('sub'), permission)
+
+            return f(verified.payload, *args, **kwargs)
+        return wrapper
+    return requires_auth_decorator
+
+
+'''
+requires_auth_async(permission)
+    requires_auth for coroutine views of the async serving mode
+
+    Same checks and errors. A token missing from the cache is verified, and a
+    configured rate limit checked, on the default executor, since a JWKS
+    refresh or a shared rate limit backend can block on the network.
+'''
+def requires_auth_async(permission=''):
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            jwt = get_token_auth_header()
+            verified = token_cache.get(jwt)
+            loop = asyncio.get_running_loop()
+            if verified is None:
+                try:
+                    payload = await loop.run_in_executor(None, verify_decode_jwt, jwt)
+                except:
+                    abort (401)
+                verified = token_cache.put(jwt, payload)
+
+            if permission:
+                check_permissions(permission, verified.payload, verified.permissions)
 
-            check_permissions(permission, payload)
+            if rate_limiter.limits:
+                await loop.run_in_executor(None, rate_limiter.check, verified.payload.get('sub'), permission)
 
-            return f(payload, *args, **kwargs)
+            return await f(verified.payload, *args, **kwargs)
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
@@ -0,0 +1,107 @@
+import os
+from bulk import validate_record
+from auth import check_permissions
+from models import db, Actor, Movie
+
+batch_max_operations = int(os.environ.get('BATCH_MAX_OPERATIONS', 100))
+
+batch_resources = {
+    'actors': Actor,
+    'movies': Movie
+}
+
+batch_permissions = {
+    'create': 'post',
+    'update': 'patch',
+    'delete': 'delete'
+}
+
+
+class BatchError(Exception):
+    def __init__(self, index, status_code, message):
+        self.index = index
+        self.status_code = status_code
+        self.message = message
+
+
+def parse_operations(body):
+    if not isinstance(body, dict) or not isinstance(body.get('operations'), list):
+        raise BatchError(None, 400, 'bad request')
+
+    operations = body['operations']
+    if not operations or len(operations) > batch_max_operations:
+        raise BatchError(None, 400, 'bad request')
+
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise BatchError(index, 400, 'bad request')
+        if operation.get('op') not in batch_permissions or operation.get('resource') not in batch_resources:
+            raise BatchError(index, 400, 'bad request')
+        if operation['op'] != 'create' and not isinstance(operation.get('id'), int):
+            raise BatchError(index, 400, 'bad request')
+
+    return operations
+
+
+'''
+authorize_operations(operations, payload)
+    checks the permission behind every operation before any of them runs
+
+    A create on actors needs post:actors, an update patch:actors and a delete
+    delete:actors, the same permissions as the single-record endpoints.
+'''
+def authorize_operations(operations, payload):
+    permissions = frozenset(payload.get('permissions', []))
+
+    for operation in operations:
+        permission = batch_permissions[operation['op']] + ':' + operation['resource']
+        check_permissions(permission, payload, permissions)
+
+
+def run_operation(index, operation):
+    model = batch_resources[operation['resource']]
+    result = {'index': index, 'op': operation['op'], 'resource': operation['resource']}
+
+    if operation['op'] == 'create' or operation['op'] == 'update':
+        data = operation.get('data')
+        error = validate_record(model, data)
+        if error is not None:
+            raise BatchError(index, 400, error)
+        fields = {field: data[field] for field in model.required_fields}
+
+    if operation['op'] == 'create':
+        record = model(**fields)
+        db.session.add(record)
+        db.session.flush()
+        result[model.__tablename__.lower()] = record.format()
+        return result
+
+    record = model.query.get(operation['id'])
+    if record is None:
+        raise BatchError(index, 404, 'resource not found')
+
+    if operation['op'] == 'update':
+        for field, value in fields.items():
+            setattr(record, field, value)
+        db.session.flush()
+        result[model.__tablename__.lower()] = record.format()
+    else:
+        db.session.delete(record)
+        db.session.flush()
+        result['deleted'] = operation['id']
+
+    return result
+
+
+'''
+run_batch(body, payload)
+    runs the create, update and delete operations of a /batch request in order
+
+    Every operation shares the session transaction; the caller commits once
+    when they all succeed and rolls back when any raises BatchError.
+'''
+def run_batch(body, payload):
+    operations = parse_operations(body)
+    authorize_operations(operations, payload)
+
+    return [run_operation(index, operation) for index, operation in enumerate(operations)]
@@ -0,0 +1,173 @@
+'''
+Compares the WSGI app on a fixed pool of worker threads with the ASGI app on
+one event loop, at increasing numbers of concurrent clients.
+
+Usage:
+    python -m benchmarks.async_serving [--concurrency 8 64 256] [--requests 2000]
+        [--threads 8] [--db-latency 5] [--rows 1000]
+
+Each client sends GET /actors?limit=20 and GET /actors/<id> back to back with a
+locally signed token; latencies include time spent queued for a worker thread.
+--db-latency adds that many milliseconds to every statement, spent inside the
+database driver, to stand in for the round trip to a networked database. The
+response cache is disabled so that every request reaches the database, and the
+connection pools are sized (DB_POOL_SIZE, 256 unless set) so that neither mode
+waits for a connection.
+'''
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import local_auth
+
+tmpdir = tempfile.TemporaryDirectory()
+local_auth.configure(tmpdir.name)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir.name, 'bench.db')
+os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+os.environ.setdefault('DB_POOL_SIZE', '256')
+
+from sqlalchemy import event
+from werkzeug.test import EnvironBuilder
+from app import create_app
+from asgi import create_asgi_app
+from models import db, Actor
+
+
+def seed(count):
+    db.create_all()
+    table = Actor.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert(), [
+        {'name': 'Actor {}'.format(i), 'age': 18 + i % 70, 'gender': ('female', 'male')[i % 2]}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+def add_latency(engine, latency):
+    @event.listens_for(engine, 'connect')
+    def register_sleep(dbapi_connection, connection_record):
+        dbapi_connection.create_function('bench_sleep', 1, lambda ms: time.sleep(ms / 1000) or 0)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def sleep(conn, cursor, statement, parameters, context, executemany):
+        cursor.execute('SELECT bench_sleep(?)', (latency,))
+
+    # connections opened before the function was registered lack it
+    engine.dispose()
+
+
+def requests_for(rows, count):
+    return [
+        ('/actors', 'limit=20') if i % 2 == 0 else ('/actors/{}'.format(1 + i % rows), '')
+        for i in range(count)
+    ]
+
+
+def call_wsgi(app, path, query, headers):
+    environ = EnvironBuilder(path=path, query_string=query, headers=headers).get_environ()
+    status = []
+    body = app(environ, lambda status_line, response_headers, exc_info=None: status.append(status_line))
+    b''.join(body)
+    if hasattr(body, 'close'):
+        body.close()
+    return int(status[0].split(' ', 1)[0])
+
+
+async def call_asgi(app, path, query, headers):
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'query_string': query.encode(),
+        'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        'http_version': '1.1'
+    }
+    started = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            started.append(message['status'])
+
+    await app(scope, receive, send)
+    return started[0]
+
+
+async def run_clients(call, requests, concurrency):
+    latencies = []
+    errors = 0
+    pending = iter(requests)
+
+    async def client():
+        nonlocal errors
+        for path, query in pending:
+            start = time.perf_counter()
+            status = await call(path, query)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return time.perf_counter() - start, latencies, errors
+
+
+def report(mode, concurrency, elapsed, latencies, errors):
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print('{:>6} {:>11} {:>9.0f} {:>9.1f} {:>9.1f} {:>7}'.format(
+        mode, concurrency, len(latencies) / elapsed,
+        statistics.median(latencies) * 1000, p99 * 1000, errors
+    ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 64, 256])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--db-latency', type=float, default=5)
+    parser.add_argument('--rows', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    wsgi = create_app()
+    asgi = create_asgi_app()
+    with wsgi.app_context():
+        seed(args.rows)
+        if args.db_latency:
+            add_latency(db.get_engine(), args.db_latency)
+    if args.db_latency:
+        add_latency(asgi.engine.sync_engine, args.db_latency)
+
+    headers = {'Authorization': 'Bearer ' + local_auth.mint_token(['get:actors'])}
+    requests = requests_for(args.rows, args.requests)
+    threads = ThreadPoolExecutor(max_workers=args.threads)
+
+    async def wsgi_call(path, query):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(threads, call_wsgi, wsgi, path, query, headers)
+
+    async def asgi_call(path, query):
+        return await call_asgi(asgi, path, query, headers)
+
+    async def run():
+        print('{:>6} {:>11} {:>9} {:>9} {:>9} {:>7}'.format('mode', 'concurrency', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+        for concurrency in args.concurrency:
+            for mode, call in (('wsgi', wsgi_call), ('asgi', asgi_call)):
+                await run_clients(call, requests[:concurrency], concurrency)
+                report(mode, concurrency, *await run_clients(call, requests, concurrency))
+        await asgi.close()
+
+    asyncio.run(run())
+    threads.shutdown()
+
+
+if __name__ == '__main__':
+    main()
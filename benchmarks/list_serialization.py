@@ -0,0 +1,79 @@
+'''
+Compares the ORM and the Core fast path for serializing GET /actors.
+
+Usage:
+    python -m benchmarks.list_serialization [--rows 10000 100000] [--repeat 5]
+
+Seeds a throwaway SQLite database with each number of actors, checks that both
+paths produce the same bytes, and reports the best time of each.
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+tmpdir = tempfile.TemporaryDirectory()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir.name, 'bench.db')
+
+from flask import jsonify
+from app import create_app
+from models import db, Actor
+from serialization import execute_rows, fast_jsonify
+
+
+def seed(count):
+    table = Actor.__table__
+    db.session.execute(table.delete())
+    db.session.execute(table.insert(), [
+        {'name': 'Actor {}'.format(i), 'age': 18 + i % 70, 'gender': ('female', 'male')[i % 2]}
+        for i in range(count)
+    ])
+    db.session.commit()
+
+
+def orm_body():
+    actors = Actor.query.order_by(Actor.id).all()
+    return jsonify({
+        'success' : True,
+        'actors' : [actor.format() for actor in actors]
+    }).get_data()
+
+
+def fast_body():
+    return fast_jsonify('actors', Actor, execute_rows(Actor.query, Actor, Actor.id)).get_data()
+
+
+def best_of(repeat, build):
+    times = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.perf_counter()
+        build()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    print('{:>10} {:>10} {:>10} {:>8}'.format('rows', 'orm (ms)', 'fast (ms)', 'speedup'))
+
+    with app.test_request_context():
+        db.create_all()
+        for count in args.rows:
+            seed(count)
+            if orm_body() != fast_body():
+                sys.exit('fast path output differs from the ORM output at {} rows'.format(count))
+
+            orm = best_of(args.repeat, orm_body)
+            fast = best_of(args.repeat, fast_body)
+            print('{:>10} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(count, orm * 1000, fast * 1000, orm / fast))
+
+
+if __name__ == '__main__':
+    main()
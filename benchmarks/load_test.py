@@ -0,0 +1,554 @@
+'''
+Load test of every route of app.py against a seeded database, reporting
+throughput and p50/p95/p99 latency per endpoint.
+
+Usage:
+    python -m benchmarks.load_test [--actors 1000] [--movies 200] [--cast-size 5]
+        [--requests 5000] [--warmup 200] [--concurrency 16] [--target wsgi|asgi]
+        [--workload synthetic|postman|FILE.jsonl] [--seed 0]
+        [--output results.json] [--compare baseline.json] [--tolerance 10]
+
+The database is a throwaway SQLite file unless LOAD_TEST_DATABASE_URL is set;
+its actors, movies and castings are replaced by --actors actors and --movies
+movies of --cast-size actors each. Tokens are signed by the local JWKS stand-in
+in benchmarks.local_auth, with the permissions of the role each request is
+sent as.
+
+Workloads:
+- synthetic (the default) is a weighted mix over every route: pages, filters,
+  field selection, embeds, search and streaming on the lists, details, casting,
+  bulk, batch, and single-record writes. Records a DELETE removes are created
+  by setup requests first, which are sent but not timed, so the seeded rows
+  stay in place for the reads.
+- postman replays the requests of casting-agency.postman_collection.json, each
+  as the role of its folder.
+- a .jsonl file replays one request per line, as
+  {"method": "GET", "path": "/actors?limit=20", "body": null, "role": "executive-producer"}
+  where body and role are optional.
+
+Requests are drawn in a fixed order from --seed, then sent by --concurrency
+clients at once: threads calling the WSGI app, or tasks on one event loop
+calling the ASGI app. The response cache is disabled so every request reaches
+the database. --output saves the results as JSON; --compare reports the
+change in each endpoint's p50 and p95 against a saved run and exits with
+status 1 when one got slower than --tolerance percent.
+'''
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlencode, urlsplit
+
+from benchmarks import local_auth
+
+tmpdir = tempfile.TemporaryDirectory()
+local_auth.configure(tmpdir.name)
+os.environ['DATABASE_URL'] = os.environ.get('LOAD_TEST_DATABASE_URL') or 'sqlite:///' + os.path.join(tmpdir.name, 'bench.db')
+os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+
+from app import create_app
+from asgi import create_asgi_app
+from models import db, Actor, Casting, Movie
+
+collection_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'casting-agency.postman_collection.json')
+
+roles = {
+    'casting-assistant': ['get:actors', 'get:movies'],
+    'casting-director': [
+        'get:actors', 'get:movies', 'post:actors', 'patch:actors', 'delete:actors', 'patch:movies'
+    ],
+    'executive-producer': local_auth.all_permissions
+}
+
+'''
+Call
+    one request of the workload
+
+    endpoint names the call in the report; setup calls have none and are not
+    timed.
+'''
+Call = namedtuple('Call', 'endpoint method path query body role', defaults=('', None, 'executive-producer'))
+
+genders = ('female', 'male')
+search_terms = ('actor 1', 'actor 42', 'movie 7', 'movie 1')
+
+
+def seed(actors, movies, cast_size):
+    db.create_all()
+    for model in (Casting, Movie, Actor):
+        db.session.execute(model.__table__.delete())
+
+    db.session.execute(Actor.__table__.insert(), [
+        {'name': 'Actor {}'.format(i), 'age': 18 + i % 70, 'gender': genders[i % 2]}
+        for i in range(actors)
+    ])
+    db.session.execute(Movie.__table__.insert(), [
+        {'title': 'Movie {}'.format(i), 'release_date': 1950 + i % 75}
+        for i in range(movies)
+    ])
+    db.session.commit()
+
+    actor_ids = [row[0] for row in db.session.query(Actor.id).order_by(Actor.id)]
+    movie_ids = [row[0] for row in db.session.query(Movie.id).order_by(Movie.id)]
+    castings = [
+        {'movie_id': movie_id, 'actor_id': actor_ids[(i * cast_size + j) % len(actor_ids)]}
+        for i, movie_id in enumerate(movie_ids)
+        for j in range(min(cast_size, len(actor_ids)))
+    ]
+    if castings:
+        db.session.execute(Casting.__table__.insert(), castings)
+    db.session.commit()
+
+    return actor_ids, movie_ids
+
+
+def actor_record(rng):
+    return {'name': 'Load Actor {}'.format(rng.randrange(10 ** 6)), 'age': rng.randrange(18, 90), 'gender': rng.choice(genders)}
+
+
+def movie_record(rng):
+    return {'title': 'Load Movie {}'.format(rng.randrange(10 ** 6)), 'release_date': rng.randrange(1950, 2025)}
+
+
+'''
+Operations of the synthetic workload
+    generators that yield the calls of one operation in order, and are sent
+    the decoded JSON body of each response
+
+    Each is given the random generator of the workload and the seeded ids.
+'''
+def simple(endpoint, method, path, query='', body=None):
+    def operation(rng, actor_ids, movie_ids):
+        yield Call(endpoint, method, path.format(actor=rng.choice(actor_ids), movie=rng.choice(movie_ids)), query, body)
+    return operation
+
+
+def query_operation(endpoint, path, make_query):
+    def operation(rng, actor_ids, movie_ids):
+        yield Call(endpoint, 'GET', path, urlencode(make_query(rng)))
+    return operation
+
+
+def write_operation(endpoint, method, path, make_body):
+    def operation(rng, actor_ids, movie_ids):
+        path_for = path.format(actor=rng.choice(actor_ids), movie=rng.choice(movie_ids))
+        yield Call(endpoint, method, path_for, body=make_body(rng))
+    return operation
+
+
+def delete_actor(rng, actor_ids, movie_ids):
+    created = yield Call(None, 'POST', '/actors/bulk', body=[actor_record(rng)])
+    yield Call('DELETE /actors/<id>', 'DELETE', '/actors/{}'.format(created['created'][0]))
+
+
+def delete_movie(rng, actor_ids, movie_ids):
+    created = yield Call(None, 'POST', '/movies/bulk', body=[movie_record(rng)])
+    yield Call('DELETE /movies/<id>', 'DELETE', '/movies/{}'.format(created['created'][0]))
+
+
+def create_casting(rng, actor_ids, movie_ids):
+    created = yield Call(None, 'POST', '/actors/bulk', body=[actor_record(rng)])
+    movie_id = rng.choice(movie_ids)
+    yield Call('POST /movies/<id>/cast', 'POST', '/movies/{}/cast'.format(movie_id), body={'actor_id': created['created'][0]})
+
+
+def delete_casting(rng, actor_ids, movie_ids):
+    created = yield Call(None, 'POST', '/actors/bulk', body=[actor_record(rng)])
+    actor_id = created['created'][0]
+    movie_id = rng.choice(movie_ids)
+    yield Call(None, 'POST', '/movies/{}/cast'.format(movie_id), body={'actor_id': actor_id})
+    yield Call('DELETE /movies/<id>/cast/<id>', 'DELETE', '/movies/{}/cast/{}'.format(movie_id, actor_id))
+
+
+def batch(rng, actor_ids, movie_ids):
+    yield Call('POST /batch', 'POST', '/batch', body={'operations': [
+        {'op': 'create', 'resource': 'actors', 'data': actor_record(rng)},
+        {'op': 'update', 'resource': 'actors', 'id': rng.choice(actor_ids), 'data': actor_record(rng)},
+        {'op': 'create', 'resource': 'movies', 'data': movie_record(rng)}
+    ]})
+
+
+def age_range(rng):
+    age_min = rng.randrange(18, 80)
+    return {'gender': rng.choice(genders), 'age_min': age_min, 'age_max': age_min + 10, 'limit': 20}
+
+
+def release_range(rng):
+    released_from = rng.randrange(1950, 2020)
+    return {'released_from': released_from, 'released_to': released_from + 5, 'limit': 20}
+
+
+synthetic_mix = [
+    (1, simple('GET /', 'GET', '/')),
+    (10, simple('GET /actors?limit', 'GET', '/actors', 'limit=20')),
+    (4, query_operation('GET /actors?filters', '/actors', age_range)),
+    (3, simple('GET /actors?fields', 'GET', '/actors', 'fields=name,age&limit=20')),
+    (3, simple('GET /actors?embed', 'GET', '/actors', 'embed=movies&limit=20')),
+    (3, query_operation('GET /actors?q', '/actors', lambda rng: {'q': rng.choice(search_terms)})),
+    (1, simple('GET /actors?stream', 'GET', '/actors', 'stream=ndjson')),
+    (1, simple('GET /actors', 'GET', '/actors')),
+    (12, simple('GET /actors/<id>', 'GET', '/actors/{actor}')),
+    (10, simple('GET /movies?limit', 'GET', '/movies', 'limit=20')),
+    (4, query_operation('GET /movies?filters', '/movies', release_range)),
+    (3, simple('GET /movies?fields', 'GET', '/movies', 'fields=title&limit=20')),
+    (3, simple('GET /movies?embed', 'GET', '/movies', 'embed=cast&limit=20')),
+    (3, query_operation('GET /movies?q', '/movies', lambda rng: {'q': rng.choice(search_terms)})),
+    (1, simple('GET /movies?stream', 'GET', '/movies', 'stream=ndjson')),
+    (1, simple('GET /movies', 'GET', '/movies')),
+    (12, simple('GET /movies/<id>', 'GET', '/movies/{movie}')),
+    (3, query_operation('GET /search', '/search', lambda rng: {'q': rng.choice(search_terms)})),
+    (5, simple('GET /movies/<id>/cast', 'GET', '/movies/{movie}/cast')),
+    (5, simple('GET /actors/<id>/movies', 'GET', '/actors/{actor}/movies')),
+    (2, write_operation('POST /actors', 'POST', '/actors', actor_record)),
+    (2, write_operation('POST /movies', 'POST', '/movies', movie_record)),
+    (1, write_operation('POST /actors/bulk', 'POST', '/actors/bulk', lambda rng: [actor_record(rng) for _ in range(10)])),
+    (1, write_operation('POST /movies/bulk', 'POST', '/movies/bulk', lambda rng: [movie_record(rng) for _ in range(10)])),
+    (3, write_operation('PATCH /actors/<id>', 'PATCH', '/actors/{actor}', actor_record)),
+    (3, write_operation('PATCH /movies/<id>', 'PATCH', '/movies/{movie}', movie_record)),
+    (1, delete_actor),
+    (1, delete_movie),
+    (1, create_casting),
+    (1, delete_casting),
+    (1, batch)
+]
+
+
+def synthetic_workload(rng, count, actor_ids, movie_ids):
+    weights = [weight for weight, _ in synthetic_mix]
+    operations = [operation for _, operation in synthetic_mix]
+    # every operation draws from its own generator, so that the requests do
+    # not depend on the order the clients happen to run them in
+    return [
+        operation(random.Random(rng.random()), actor_ids, movie_ids)
+        for operation in rng.choices(operations, weights, k=count)
+    ]
+
+
+def endpoint_for(method, path):
+    return method + ' ' + (re.sub(r'/\d+(?=/|$)', '/<id>', path) or '/')
+
+
+def replayed(method, url, body=None, role='executive-producer'):
+    url = urlsplit(url)
+    yield Call(endpoint_for(method, url.path), method, url.path or '/', url.query, body, role)
+
+
+def postman_requests(items, role=None):
+    for item in items:
+        if 'item' in item:
+            yield from postman_requests(item['item'], item['name'] if item['name'] in roles else role)
+            continue
+
+        request = item['request']
+        url = request['url'] if isinstance(request['url'], str) else request['url']['raw']
+        raw_body = (request.get('body') or {}).get('raw')
+        yield request['method'], url.replace('{{host}}', ''), json.loads(raw_body) if raw_body else None, role or 'executive-producer'
+
+
+def replay_workload(rng, count, requests):
+    return [replayed(*rng.choice(requests)) for _ in range(count)]
+
+
+def load_workload(name, rng, count, actor_ids, movie_ids):
+    if name == 'synthetic':
+        return synthetic_workload(rng, count, actor_ids, movie_ids)
+
+    if name == 'postman':
+        with open(collection_path) as collection_file:
+            return replay_workload(rng, count, list(postman_requests(json.load(collection_file)['item'])))
+
+    with open(name) as replay_file:
+        requests = [json.loads(line) for line in replay_file if line.strip()]
+    return replay_workload(rng, count, [
+        (request['method'], request['path'], request.get('body'), request.get('role', 'executive-producer'))
+        for request in requests
+    ])
+
+
+def decode(body):
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+'''
+Recorder
+    latencies and status codes of the timed calls, by endpoint
+'''
+class Recorder:
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, status, elapsed):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+
+def run_operation(send, operation, recorder):
+    call = next(operation)
+    while True:
+        start = time.perf_counter()
+        status, body = send(call)
+        elapsed = time.perf_counter() - start
+        if call.endpoint is not None and recorder is not None:
+            recorder.record(call.endpoint, status, elapsed)
+        try:
+            call = operation.send(decode(body))
+        except StopIteration:
+            return
+        except (KeyError, IndexError, TypeError):
+            # a setup call failed; its status is all there is to report
+            return
+
+
+def run_wsgi(app, tokens, operations, concurrency, recorder):
+    pending = iter(operations)
+    lock = threading.Lock()
+
+    def client():
+        test_client = app.test_client()
+
+        def send(call):
+            response = test_client.open(
+                call.path, method=call.method, query_string=call.query, json=call.body,
+                headers={'Authorization': 'Bearer ' + tokens[call.role]}
+            )
+            return response.status_code, response.get_data()
+
+        while True:
+            with lock:
+                operation = next(pending, None)
+            if operation is None:
+                return
+            run_operation(send, operation, recorder)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+async def call_asgi(app, call, token):
+    body = json.dumps(call.body).encode() if call.body is not None else b''
+    headers = [(b'authorization', ('Bearer ' + token).encode())]
+    if call.body is not None:
+        headers.append((b'content-type', b'application/json'))
+
+    scope = {
+        'type': 'http',
+        'method': call.method,
+        'path': call.path,
+        'query_string': call.query.encode(),
+        'headers': headers,
+        'http_version': '1.1'
+    }
+    status = []
+    chunks = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+        else:
+            chunks.append(message.get('body', b''))
+
+    await app(scope, receive, send)
+    return status[0], b''.join(chunks)
+
+
+def run_asgi(app, loop, tokens, operations, concurrency, recorder):
+    async def run_async_operation(operation):
+        call = next(operation)
+        while True:
+            start = time.perf_counter()
+            status, body = await call_asgi(app, call, tokens[call.role])
+            elapsed = time.perf_counter() - start
+            if call.endpoint is not None and recorder is not None:
+                recorder.record(call.endpoint, status, elapsed)
+            try:
+                call = operation.send(decode(body))
+            except StopIteration:
+                return
+            except (KeyError, IndexError, TypeError):
+                return
+
+    async def run():
+        pending = iter(operations)
+
+        async def client():
+            for operation in pending:
+                await run_async_operation(operation)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+        return time.perf_counter() - start
+
+    return loop.run_until_complete(run())
+
+
+def percentile(ordered, p):
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'throughput': len(ordered) / elapsed,
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'max_ms': ordered[-1] * 1000
+    }
+
+
+def results_for(recorder, elapsed, args, dialect):
+    endpoints = {}
+    for endpoint in sorted(recorder.latencies):
+        endpoints[endpoint] = summarize(recorder.latencies[endpoint], elapsed)
+        endpoints[endpoint]['statuses'] = {str(status): count for status, count in sorted(recorder.statuses[endpoint].items())}
+
+    overall = summarize([latency for latencies in recorder.latencies.values() for latency in latencies], elapsed)
+    overall['elapsed_s'] = elapsed
+
+    return {
+        'run': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': dialect,
+            'options': vars(args)
+        },
+        'overall': overall,
+        'endpoints': endpoints
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(collection_path)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results):
+    print('{:<32} {:>7} {:>8} {:>8} {:>8} {:>8}  {}'.format('endpoint', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'statuses'))
+    rows = list(results['endpoints'].items()) + [('overall', results['overall'])]
+    for endpoint, stats in rows:
+        statuses = ' '.join('{}x{}'.format(status, count) for status, count in stats.get('statuses', {}).items())
+        print('{:<32} {:>7} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}  {}'.format(
+            endpoint, stats['requests'], stats['throughput'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], statuses
+        ))
+
+
+'''
+compare(baseline, results, tolerance)
+    prints the change in p50 and p95 of every endpoint found in both runs
+
+    Returns the endpoints whose p95 grew by more than tolerance percent.
+'''
+def compare(baseline, results, tolerance):
+    regressions = []
+    print('{:<32} {:>10} {:>10} {:>10} {:>10}'.format('endpoint', 'p50 base', 'p50 now', 'p95 base', 'p95 now'))
+    rows = [(endpoint, baseline['endpoints'].get(endpoint), stats) for endpoint, stats in results['endpoints'].items()]
+    rows.append(('overall', baseline['overall'], results['overall']))
+
+    for endpoint, before, after in rows:
+        if before is None:
+            continue
+        change = (after['p95_ms'] / before['p95_ms'] - 1) * 100 if before['p95_ms'] else 0
+        slower = change > tolerance
+        if slower:
+            regressions.append(endpoint)
+        print('{:<32} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>+7.0f}%{}'.format(
+            endpoint, before['p50_ms'], after['p50_ms'], before['p95_ms'], after['p95_ms'],
+            change, '  regression' if slower else ''
+        ))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=200)
+    parser.add_argument('--cast-size', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--target', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--workload', default='synthetic')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=10)
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    with app.app_context():
+        actor_ids, movie_ids = seed(args.actors, args.movies, args.cast_size)
+        dialect = db.engine.dialect.name
+
+    rng = random.Random(args.seed)
+    tokens = {role: local_auth.mint_token(permissions) for role, permissions in roles.items()}
+    operations = load_workload(args.workload, rng, args.warmup + args.requests, actor_ids, movie_ids)
+
+    if args.target == 'asgi':
+        asgi = create_asgi_app()
+        loop = asyncio.new_event_loop()
+        run = lambda operations, recorder: run_asgi(asgi, loop, tokens, operations, args.concurrency, recorder)
+    else:
+        run = lambda operations, recorder: run_wsgi(app, tokens, operations, args.concurrency, recorder)
+
+    run(operations[:args.warmup], None)
+    recorder = Recorder()
+    elapsed = run(operations[args.warmup:], recorder)
+
+    if args.target == 'asgi':
+        loop.run_until_complete(asgi.close())
+        loop.close()
+
+    results = results_for(recorder, elapsed, args, dialect)
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.tolerance)
+        if regressions:
+            print('slower than {:g}% over the baseline: {}'.format(args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
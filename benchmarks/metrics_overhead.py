@@ -0,0 +1,99 @@
+'''
+Measures the cost of METRICS_ENABLED on the request path.
+
+Usage:
+    python -m benchmarks.metrics_overhead [--requests 2000] [--repeat 5]
+
+Sends the same requests through the test client of an app without and an app
+with instrumentation, alternating between them, and reports the best mean time
+per request of each. The engine events are process-wide once installed, so the
+uninstrumented numbers include their no-op check. Since the difference is
+within run-to-run noise, the time spent in the instrumentation hooks for one
+request running two statements is also measured on its own.
+'''
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import local_auth
+
+tmpdir = tempfile.TemporaryDirectory()
+local_auth.configure(tmpdir.name)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir.name, 'bench.db')
+os.environ['RESPONSE_CACHE_MAX_BYTES'] = '0'
+
+from types import SimpleNamespace
+from app import create_app
+from metrics import after_cursor_execute, before_cursor_execute, finish_request, start_request
+from models import db, Actor
+
+paths = ['/actors/1', '/actors?limit=50']
+
+
+def seed(app, count):
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Actor.__table__.insert(), [
+            {'name': 'Actor {}'.format(i), 'age': 18 + i % 70, 'gender': ('female', 'male')[i % 2]}
+            for i in range(count)
+        ])
+        db.session.commit()
+
+
+def mean_time(client, path, headers, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.get(path, headers=headers)
+    return (time.perf_counter() - start) / requests
+
+
+def measure(apps, path, headers, requests, repeat):
+    clients = [app.test_client() for app in apps]
+    for client in clients:
+        client.get(path, headers=headers)
+
+    best = [None] * len(apps)
+    for _ in range(repeat):
+        for i, client in enumerate(clients):
+            elapsed = mean_time(client, path, headers, requests)
+            best[i] = elapsed if best[i] is None else min(best[i], elapsed)
+    return best
+
+
+def hook_time(app, path, iterations=20000):
+    response = app.response_class('')
+    with app.test_request_context(path):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            start_request()
+            for _ in range(2):
+                context = SimpleNamespace()
+                before_cursor_execute(None, None, '', None, context, False)
+                after_cursor_execute(None, None, '', None, context, False)
+            finish_request(response)
+        return (time.perf_counter() - start) / iterations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    headers = {'Authorization': 'Bearer ' + local_auth.mint_token(['get:actors'])}
+
+    plain = create_app({'METRICS_ENABLED': False})
+    instrumented = create_app({'METRICS_ENABLED': True})
+    seed(plain, 1000)
+
+    print('{:>18} {:>10} {:>10} {:>10}'.format('path', 'off (us)', 'on (us)', 'overhead'))
+    for path in paths:
+        off, on = measure([plain, instrumented], path, headers, args.requests, args.repeat)
+        print('{:>18} {:>10.1f} {:>10.1f} {:>9.1f}%'.format(path, off * 1e6, on * 1e6, (on / off - 1) * 100))
+
+    print('instrumentation hooks: {:.1f} us per request'.format(hook_time(instrumented, paths[0]) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
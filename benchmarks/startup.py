@@ -0,0 +1,61 @@
+'''
+Measures cold start: importing the app module and calling create_app().
+
+Usage:
+    python -m benchmarks.startup [--runs 10]
+
+Each run is a fresh interpreter. DATABASE_URL points at a database that cannot
+be opened, so a run only succeeds if startup never touches the database.
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+probe = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({"import": imported - start, "create_app": created - imported}))
+'''
+
+
+def run_once(env):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', probe],
+        env = env, capture_output = True, text = True, check = True
+    )
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process'] = time.perf_counter() - start
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = dict(os.environ)
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir, 'missing', 'casting.db')
+        env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+
+        runs = [run_once(env) for _ in range(args.runs)]
+
+    print('{:>12} {:>10} {:>10}'.format('phase', 'median ms', 'min ms'))
+    for phase in ('import', 'create_app', 'process'):
+        values = [run[phase] * 1000 for run in runs]
+        print('{:>12} {:>10.1f} {:>10.1f}'.format(phase, statistics.median(values), min(values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+from flask import abort
+from models import db
+
+bulk_chunk_size = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+
+
+'''
+validate_record(model, record)
+    checks record against model.required_fields
+
+    Returns an error message, or None when the record can be inserted.
+'''
+def validate_record(model, record):
+    if not isinstance(record, dict):
+        return 'record must be an object'
+
+    for field, field_type in model.required_fields.items():
+        if field not in record:
+            return 'missing field: ' + field
+
+        value = record[field]
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            return 'invalid value for field: ' + field
+
+    return None
+
+
+'''
+iter_records(request)
+    yields (index, record, error) for every record in a bulk request
+
+    The body is either a JSON array or, with Content-Type application/x-ndjson,
+    one JSON object per line. NDJSON is read line by line from the request
+    stream, so the whole body is never held in memory at once.
+'''
+def iter_records(request):
+    if request.mimetype == 'application/x-ndjson':
+        index = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
+            try:
+                yield index, json.loads(line), None
+            except ValueError:
+                yield index, None, 'malformed JSON'
+            index += 1
+        return
+
+    records = request.get_json(silent=True)
+    if not isinstance(records, list):
+        abort(400)
+
+    for index, record in enumerate(records):
+        yield index, record, None
+
+
+'''
+insert_chunk(model, rows)
+    inserts rows in one statement and returns their ids in order
+
+    Uses INSERT ... VALUES ... RETURNING id where the dialect supports it, and
+    falls back to one INSERT per row elsewhere (SQLite) to learn the ids.
+'''
+def insert_chunk(model, rows):
+    table = model.__table__
+
+    if db.engine.dialect.full_returning:
+        result = db.session.execute(table.insert().values(rows).returning(table.c.id))
+        return [row[0] for row in result]
+
+    return [
+        db.session.execute(table.insert().values(row)).inserted_primary_key[0]
+        for row in rows
+    ]
+
+
+'''
+bulk_insert(model, request)
+    inserts every valid record of a bulk request inside the session transaction
+
+    Valid records are inserted in chunks of BULK_CHUNK_SIZE; invalid ones are
+    skipped and reported by index. The caller commits or rolls back.
+'''
+def bulk_insert(model, request):
+    created = []
+    errors = []
+    chunk = []
+
+    for index, record, error in iter_records(request):
+        if error is None:
+            error = validate_record(model, record)
+
+        if error is not None:
+            errors.append({'index': index, 'message': error})
+            continue
+
+        chunk.append({field: record[field] for field in model.required_fields})
+        if len(chunk) >= bulk_chunk_size:
+            created.extend(insert_chunk(model, chunk))
+            chunk = []
+
+    if chunk:
+        created.extend(insert_chunk(model, chunk))
+
+    if not created and not errors:
+        abort(400)
+
+    return created, errors
@@ -0,0 +1,148 @@
+import os
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+compress_min_size = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+compress_gzip_level = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+compress_brotli_quality = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+compress_zstd_level = int(os.environ.get('COMPRESS_ZSTD_LEVEL', 3))
+compress_stream_flush_bytes = int(os.environ.get('COMPRESS_STREAM_FLUSH_BYTES', 16 * 1024))
+
+compressible_mimetypes = {'application/json', 'application/x-ndjson', 'text/plain', 'text/html'}
+
+
+class GzipCompressor:
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(compress_gzip_level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def sync(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality = compress_brotli_quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def sync(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level = compress_zstd_level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def sync(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+# preferred first when the client accepts several with the same quality
+compressors = {}
+if brotli is not None:
+    compressors['br'] = BrotliCompressor
+if zstandard is not None:
+    compressors['zstd'] = ZstdCompressor
+compressors['gzip'] = GzipCompressor
+
+
+def negotiate_encoding():
+    return request.accept_encodings.best_match(list(compressors))
+
+
+'''
+compressed_chunks(chunks, compressor, charset, flush_bytes)
+    compresses a streamed body as it is produced
+
+    The compressor is flushed once at least flush_bytes (default
+    COMPRESS_STREAM_FLUSH_BYTES) of the body went in since the last flush,
+    rather than after every chunk: streams yield one row per chunk, and a
+    flush per row would cost framing bytes, CPU and compression ratio. Output
+    the compressor produces in between is passed on at once.
+'''
+def compressed_chunks(chunks, compressor, charset='utf-8', flush_bytes=None):
+    flush_bytes = flush_bytes or compress_stream_flush_bytes
+    pending = 0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= flush_bytes:
+                data += compressor.sync()
+                pending = 0
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+'''
+compress_response(response)
+    compresses a response with the best encoding the client accepts
+
+    Complete bodies smaller than COMPRESS_MIN_SIZE are left alone. Streamed
+    bodies are always compressed, chunk by chunk, since their size is not
+    known up front.
+'''
+def compress_response(response):
+    if response.mimetype not in compressible_mimetypes:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or request.method == 'HEAD'):
+        return response
+
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    compressor = compressors[encoding]()
+
+    if response.is_streamed:
+        response.response = compressed_chunks(response.response, compressor, response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < compress_min_size:
+            return response
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,69 @@
+from functools import wraps
+from flask import g, jsonify, make_response, request
+from models import get_table_versions
+
+
+def request_models(models, embeds):
+    embed = request.args.get('embed')
+    if embeds and embed in embeds:
+        return models + tuple(embeds[embed])
+    return models
+
+
+def versions_etag(names, versions):
+    return '-'.join('{}.{}'.format(name, versions[name]) for name in names)
+
+
+def table_etag(*models):
+    names = [model.__tablename__ for model in models]
+    return versions_etag(names, get_table_versions(*names))
+
+
+'''
+conditional_get(*models, embeds)
+    adds an ETag to a read endpoint built from the tables of models
+
+    The tag is made from the tables' version counters, so a request whose
+    If-None-Match still matches is answered with 304 Not Modified without the
+    view running or the tables being read. embeds maps values of the embed
+    query parameter to the extra models those responses are read from. Goes
+    below requires_auth so that only authorised callers learn whether anything
+    changed.
+'''
+def conditional_get(*models, embeds=None):
+    def conditional_get_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = g.table_etag = table_etag(*request_models(models, embeds))
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag, weak=True)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+            return response
+        return wrapper
+    return conditional_get_decorator
+
+
+'''
+record_response(body, version)
+    the 200 response of a single record read, with the record's version as a
+    strong ETag
+
+    That is the "<version>" tag PATCH and DELETE take as If-Match and PATCH
+    sends back, so a client can update what it has read. A request whose
+    If-None-Match still matches the version is answered with 304 Not
+    Modified.
+'''
+def record_response(body, version):
+    etag = str(version)
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(jsonify(body), 200)
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,43 @@
+from flask import abort
+
+
+'''
+get_fields(args, model)
+    reads the comma separated fields parameter of a read request
+
+    Returns None when fields is not given, otherwise the requested column
+    names. Unknown names are a bad request.
+'''
+def get_fields(args, model):
+    if 'fields' not in args:
+        return None
+
+    fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+    columns = model.__table__.columns
+
+    if not fields or any(field not in columns for field in fields):
+        abort(400)
+
+    return list(dict.fromkeys(fields))
+
+
+'''
+select_fields(query, model, fields)
+    makes query select only the requested columns instead of whole ORM objects
+
+    The id column is always selected so that keyset pagination can still build
+    its cursor, even when it is not among the fields sent back.
+'''
+def select_fields(query, model, fields):
+    return query.with_entities(*field_columns(model, fields))
+
+
+def field_columns(model, fields):
+    columns = model.__table__.columns
+    return [columns[name] for name in dict.fromkeys(['id', *fields])]
+
+
+def format_fields(fields):
+    def format_row(row):
+        return {field: getattr(row, field) for field in fields}
+    return format_row
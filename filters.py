@@ -0,0 +1,53 @@
+from flask import abort
+from models import Actor, Movie
+
+
+def int_arg(args, name):
+    if name not in args:
+        return None
+
+    try:
+        return int(args[name])
+    except ValueError:
+        abort(400)
+
+
+'''
+filter_actors(query, args)
+    narrows an actor query by the age_min, age_max and gender parameters
+
+    Bounds are inclusive. Backed by the ix_Actor_age and ix_Actor_gender_age
+    indexes.
+'''
+def filter_actors(query, args):
+    age_min = int_arg(args, 'age_min')
+    age_max = int_arg(args, 'age_max')
+    gender = args.get('gender')
+
+    if gender is not None:
+        query = query.filter(Actor.gender == gender)
+    if age_min is not None:
+        query = query.filter(Actor.age >= age_min)
+    if age_max is not None:
+        query = query.filter(Actor.age <= age_max)
+
+    return query
+
+
+'''
+filter_movies(query, args)
+    narrows a movie query by the released_from and released_to parameters
+
+    Both are inclusive release years. Backed by the ix_Movie_release_date
+    index.
+'''
+def filter_movies(query, args):
+    released_from = int_arg(args, 'released_from')
+    released_to = int_arg(args, 'released_to')
+
+    if released_from is not None:
+        query = query.filter(Movie.release_date >= released_from)
+    if released_to is not None:
+        query = query.filter(Movie.release_date <= released_to)
+
+    return query
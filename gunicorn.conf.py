@@ -0,0 +1,104 @@
+# Production settings for gunicorn, which reads this file from the working
+# directory: run `gunicorn` from the repository root. Every setting can be
+# overridden from the environment, or on the command line.
+
+import multiprocessing
+import os
+
+cpu_count = multiprocessing.cpu_count()
+
+wsgi_app = 'app:app'
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:' + os.environ.get('PORT', '8000'))
+
+# gthread serves each worker's requests on a thread pool, which suits an app
+# that spends most of a request waiting on the database; sync serves one
+# request per worker at a time
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(cpu_count * 2 + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 4 if worker_class == 'gthread' else 1))
+
+# every worker has its own pools, one for the primary and one per replica,
+# so their sizes are derived from the connections all workers together may
+# open to each database: one per thread, plus overflow up to the worker's
+# share. DB_POOL_SIZE and DB_MAX_OVERFLOW, when set, win; the overflow is
+# never negative by default, which QueuePool would take as unlimited
+db_max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 40))
+worker_connections = max(1, db_max_connections // workers)
+os.environ.setdefault('DB_POOL_SIZE', str(min(threads, worker_connections)))
+os.environ.setdefault('DB_MAX_OVERFLOW', str(max(0, worker_connections - int(os.environ['DB_POOL_SIZE']))))
+
+# the app is built once in the master and forked, so workers start faster
+# and share its memory; post_fork gives each worker its own connections
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# workers are replaced after max_requests requests (give or take the jitter,
+# so they do not all restart at once), finishing the requests in flight
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+
+
+def preloaded_app(server):
+    return getattr(server.app, 'callable', None)
+
+
+def on_starting(server):
+    # counters start from zero with every server start
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir:
+        from metrics import clear_states
+        clear_states(metrics_dir)
+
+    pool_size = int(os.environ['DB_POOL_SIZE'])
+    max_overflow = int(os.environ['DB_MAX_OVERFLOW'])
+    if workers * pool_size > db_max_connections:
+        raise RuntimeError(
+            'DB_POOL_SIZE={} keeps {} connections open to each database across {} workers, '
+            'more than DB_MAX_CONNECTIONS ({})'.format(pool_size, workers * pool_size, workers, db_max_connections)
+        )
+    if max_overflow < 0:
+        server.log.warning('DB_MAX_OVERFLOW is negative, so workers may open any number of connections')
+    elif workers * (pool_size + max_overflow) > db_max_connections:
+        server.log.warning(
+            'workers may open %d connections to each database, more than DB_MAX_CONNECTIONS (%d)',
+            workers * (pool_size + max_overflow), db_max_connections
+        )
+
+
+'''
+pre_fork(server, worker)
+    closes the master's pooled connections before each fork, so that no
+    worker inherits one
+'''
+def pre_fork(server, worker):
+    from models import dispose_engines
+    app = preloaded_app(server)
+    if app is not None:
+        dispose_engines(app)
+
+
+'''
+post_fork(server, worker)
+    resets the worker's connection pools, so that it opens its own
+    connections whatever the master did before forking
+'''
+def post_fork(server, worker):
+    from models import dispose_engines
+    app = preloaded_app(server)
+    if app is not None:
+        dispose_engines(app)
+
+
+'''
+worker_exit(server, worker)
+    keeps the counts of an exiting worker in METRICS_DIR, when set
+'''
+def worker_exit(server, worker):
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir:
+        from metrics import archive_state
+        archive_state(metrics_dir)
@@ -0,0 +1,448 @@
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+metrics_dir = os.environ.get('METRICS_DIR')
+metrics_write_interval = float(os.environ.get('METRICS_WRITE_INTERVAL', 5))
+
+default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+query_count_buckets = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = []
+    for name, value in zip(labelnames, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def empty(self):
+        return Counter(self.name, self.documentation, self.labelnames)
+
+    def state(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def add_state(self, state):
+        with self._lock:
+            for key, value in state:
+                key = tuple(key)
+                self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name + format_labels(self.labelnames, key), value
+
+
+'''
+Histogram
+    Prometheus histogram: per label set, a count of observations in each
+    bucket plus their sum and count
+
+    Observations are counted in the first bucket they fit and made cumulative
+    only when rendered, so observe() is one bisect and three additions.
+'''
+class Histogram:
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return entry[2] if entry else 0
+
+    def sum(self, **labels):
+        entry = self._values.get(tuple(labels[name] for name in self.labelnames))
+        return entry[1] if entry else 0.0
+
+    def timed(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - start)
+        return wrapper
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def empty(self):
+        return Histogram(self.name, self.documentation, self.labelnames, self.buckets)
+
+    def state(self):
+        with self._lock:
+            return [[list(key), list(counts), total, count] for key, (counts, total, count) in self._values.items()]
+
+    def add_state(self, state):
+        with self._lock:
+            for key, counts, total, count in state:
+                entry = self._values.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+
+        labelnames = self.labelnames + ('le',)
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket' + format_labels(labelnames, key + (format_value(bound),)), cumulative
+            yield self.name + '_sum' + format_labels(self.labelnames, key), total
+            yield self.name + '_count' + format_labels(self.labelnames, key), count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def state(self):
+        return {metric.name: metric.state() for metric in self.metrics}
+
+    def merged(self, states):
+        registry = Registry()
+        for metric in self.metrics:
+            total = registry.register(metric.empty())
+            for state in states:
+                total.add_state(state.get(metric.name, []))
+        return registry
+
+    def render(self, gauges=()):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('{} {}'.format(name, format_value(value)))
+
+        for name, documentation, samples in gauges:
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, format_labels(tuple(labels), tuple(labels.values())), format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'http_requests_total', 'Requests served, by route, method and status code.',
+    ('route', 'method', 'status')
+))
+http_request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time to build the response, by route and method.',
+    ('route', 'method')
+))
+auth_verify_duration = registry.register(Histogram(
+    'auth_verify_seconds', 'Time spent in verify_decode_jwt, including any JWKS fetch.'
+))
+db_queries_per_request = registry.register(Histogram(
+    'db_queries_per_request', 'SQL statements executed per request, by route.',
+    ('route',), query_count_buckets
+))
+db_query_duration_per_request = registry.register(Histogram(
+    'db_query_seconds_per_request', 'Time spent executing SQL per request, by route.',
+    ('route',)
+))
+requests_rejected = registry.register(Counter(
+    'requests_rejected_total', 'Requests turned away by rate limits or the concurrency cap, by reason.',
+    ('reason',)
+))
+cache_lookups = registry.register(Counter(
+    'cache_lookups_total', 'Lookups in the token and response caches, by cache and whether they hit.',
+    ('cache', 'result')
+))
+app_errors = registry.register(Counter(
+    'app_errors_total', 'Exceptions caught by route handlers and turned into error responses.',
+    ('route', 'exception')
+))
+
+
+'''
+QueryStats
+    SQL statements executed, and the time spent on them, during one request
+'''
+class QueryStats:
+
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+current_queries = ContextVar('current_queries', default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current_queries.get() is not None:
+        context.metrics_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_queries.get()
+    start = getattr(context, 'metrics_start', None)
+    if stats is not None and start is not None:
+        stats.count += 1
+        stats.seconds += time.perf_counter() - start
+
+
+def request_route(req=request):
+    rule = req.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def start_request():
+    if metrics_dir:
+        start_state_writer(metrics_dir)
+    queries = QueryStats()
+    g.metrics_request = (time.perf_counter(), queries, current_queries.set(queries))
+
+
+def finish_request(response):
+    started = g.pop('metrics_request', None)
+    if started is None:
+        return response
+
+    start, queries, token = started
+    current_queries.reset(token)
+
+    req = request._get_current_object()
+    route = request_route(req)
+    http_request_duration.observe(time.perf_counter() - start, route = route, method = req.method)
+    http_requests.inc(route = route, method = req.method, status = response.status_code)
+    db_queries_per_request.observe(queries.count, route = route)
+    db_query_duration_per_request.observe(queries.seconds, route = route)
+    return response
+
+
+'''
+instrument(app)
+    records the latency, status and SQL statements of every request to app
+
+    SQL is timed through engine events on every engine in the process; they
+    do nothing outside an instrumented request. The time of a streamed
+    response ends when the stream starts.
+'''
+def instrument(app):
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+    app.before_request_funcs.setdefault(None, []).insert(0, start_request)
+    app.after_request(finish_request)
+
+
+'''
+log_exception(e)
+    reports an exception a route handler caught before answering with an error
+
+    Logged with its traceback through the app's logger and counted in
+    app_errors_total.
+'''
+def log_exception(e):
+    route = request_route()
+    app_errors.inc(route = route, exception = type(e).__name__)
+    current_app.logger.error('%s %s failed', request.method, request.path, exc_info = e)
+
+
+pool_documentation = {
+    'checkouts' : 'Connections checked out of the pool by this worker.',
+    'timeouts' : 'Checkouts that gave up waiting for a connection.',
+    'wait_seconds_total' : 'Time spent waiting to check out connections.',
+    'wait_seconds_max' : 'Longest wait to check out a connection.',
+    'size' : 'Connections the pool keeps open.',
+    'checked_out' : 'Connections in use.',
+    'checked_in' : 'Idle connections in the pool.',
+    'overflow' : 'Connections open beyond the pool size.'
+}
+
+
+'''
+pool_gauges(pools)
+    gauges of the pool_metrics of each database, labelled with its name
+'''
+def pool_gauges(pools):
+    names = dict.fromkeys(name for metrics in pools.values() for name in metrics)
+    return [
+        ('db_pool_' + name, pool_documentation[name], [
+            ({'database' : database}, metrics[name]) for database, metrics in pools.items() if name in metrics
+        ])
+        for name in names
+    ]
+
+
+'''
+Multiprocess mode
+
+With METRICS_DIR set, every worker process writes the state of its counters
+and histograms to worker-<pid>.json in that directory, every
+METRICS_WRITE_INTERVAL seconds and before answering a scrape, and a scrape
+renders the sum of every file found there. So whichever worker answers,
+/metrics covers all of them. Files of workers that exited stay counted: a
+worker leaving cleanly folds its state into archive.json (see
+archive_state), one that was killed leaves its last write behind. Gauges
+stay those of the worker answering.
+'''
+def state_path(directory, pid=None):
+    return os.path.join(directory, 'worker-{}.json'.format(pid or os.getpid()))
+
+
+def write_json(path, data):
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as state_file:
+        json.dump(data, state_file)
+    os.replace(temporary, path)
+
+
+def read_json(path):
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextmanager
+def locked(directory, operation):
+    with open(os.path.join(directory, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def write_state(directory):
+    write_json(state_path(directory), registry.state())
+
+
+writer_pid = None
+
+
+def start_state_writer(directory, interval=None):
+    global writer_pid
+    if writer_pid == os.getpid():
+        return
+    writer_pid = os.getpid()
+
+    def write_periodically():
+        while True:
+            time.sleep(interval or metrics_write_interval)
+            try:
+                write_state(directory)
+            except OSError:
+                pass
+
+    threading.Thread(target = write_periodically, daemon = True).start()
+
+
+def collect_states(directory):
+    write_state(directory)
+    with locked(directory, fcntl.LOCK_SH):
+        return [read_json(path) for path in sorted(glob.glob(os.path.join(directory, '*.json')))]
+
+
+'''
+archive_state(directory)
+    folds this worker's state into archive.json and removes its own file,
+    so that workers recycled by gunicorn do not pile up files
+'''
+def archive_state(directory):
+    archive_path = os.path.join(directory, 'archive.json')
+    with locked(directory, fcntl.LOCK_EX):
+        archive = registry.merged([read_json(archive_path), registry.state()])
+        write_json(archive_path, archive.state())
+        try:
+            os.remove(state_path(directory))
+        except OSError:
+            pass
+
+
+def clear_states(directory):
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+def render_metrics(gauges=()):
+    if metrics_dir:
+        return registry.merged(collect_states(metrics_dir)).render(gauges)
+    return registry.render(gauges)
@@ -0,0 +1,38 @@
+"""castings and table versions
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Casting',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['Actor.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['Movie.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_Casting_actor_id'), 'Casting', ['actor_id'], unique=False)
+    op.create_table('TableVersion',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('TableVersion')
+    op.drop_index(op.f('ix_Casting_actor_id'), table_name='Casting')
+    op.drop_table('Casting')
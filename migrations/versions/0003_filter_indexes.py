@@ -0,0 +1,28 @@
+"""indexes for actor and movie filters
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_Actor_age'), 'Actor', ['age'], unique=False)
+    op.create_index('ix_Actor_gender_age', 'Actor', ['gender', 'age'], unique=False)
+    op.create_index(op.f('ix_Movie_release_date'), 'Movie', ['release_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Movie_release_date'), table_name='Movie')
+    op.drop_index('ix_Actor_gender_age', table_name='Actor')
+    op.drop_index(op.f('ix_Actor_age'), table_name='Actor')
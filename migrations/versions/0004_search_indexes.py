@@ -0,0 +1,60 @@
+"""search indexes for actor names and movie titles
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+searched = [('Actor', 'name'), ('Movie', 'title')]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in searched:
+            op.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{column}_trgm" ON "{table}" USING gin ({column} gin_trgm_ops)')
+
+    elif dialect == 'sqlite':
+        for table, column in searched:
+            search_table = table + 'Search'
+            op.execute(f'CREATE VIRTUAL TABLE "{search_table}" USING fts5({column}, content=\'{table}\', content_rowid=\'id\', prefix=\'2 3\')')
+            op.execute(
+                f'CREATE TRIGGER "{table}_search_insert" AFTER INSERT ON "{table}" BEGIN '
+                f'INSERT INTO "{search_table}"(rowid, {column}) VALUES (new.id, new.{column}); END'
+            )
+            op.execute(
+                f'CREATE TRIGGER "{table}_search_delete" AFTER DELETE ON "{table}" BEGIN '
+                f'INSERT INTO "{search_table}"("{search_table}", rowid, {column}) VALUES (\'delete\', old.id, old.{column}); END'
+            )
+            op.execute(
+                f'CREATE TRIGGER "{table}_search_update" AFTER UPDATE OF {column} ON "{table}" BEGIN '
+                f'INSERT INTO "{search_table}"("{search_table}", rowid, {column}) VALUES (\'delete\', old.id, old.{column}); '
+                f'INSERT INTO "{search_table}"(rowid, {column}) VALUES (new.id, new.{column}); END'
+            )
+            op.execute(f'INSERT INTO "{search_table}"("{search_table}") VALUES (\'rebuild\')')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        for table, column in searched:
+            op.execute(f'DROP INDEX IF EXISTS "ix_{table}_{column}_trgm"')
+
+    elif dialect == 'sqlite':
+        for table, column in searched:
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER IF EXISTS "{table}_search_{trigger}"')
+            op.execute(f'DROP TABLE IF EXISTS "{table}Search"')
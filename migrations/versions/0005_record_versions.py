@@ -0,0 +1,26 @@
+"""version counters on actors and movies
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Actor', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('Movie', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Movie', 'version')
+    op.drop_column('Actor', 'version')
@@ -0,0 +1,103 @@
+"""catalog statistics kept by triggers
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+# dimensions counted for each table, with the SQL of a row's key
+counted = {
+    'Actor': [
+        ('actors_by_gender', "COALESCE({row}.gender, 'unknown')"),
+        ('actors_by_age', "COALESCE(CAST({row}.age / 10 * 10 AS TEXT), 'unknown')")
+    ],
+    'Movie': [
+        ('movies_by_release_year', "COALESCE(CAST({row}.release_date AS TEXT), 'unknown')")
+    ]
+}
+counted_columns = {'Actor': 'gender, age', 'Movie': 'release_date'}
+stat_count = '"CatalogStat".count'
+
+
+def increments(table, row, count_column):
+    return [
+        f'INSERT INTO "CatalogStat"(dimension, key, count) VALUES (\'{dimension}\', {key.format(row=row)}, 1) '
+        f'ON CONFLICT (dimension, key) DO UPDATE SET count = {count_column} + 1'
+        for dimension, key in counted[table]
+    ]
+
+
+def decrements(table, row):
+    return [
+        f'UPDATE "CatalogStat" SET count = count - 1 WHERE dimension = \'{dimension}\' AND key = {key.format(row=row)}'
+        for dimension, key in counted[table]
+    ]
+
+
+def upgrade():
+    op.create_table('CatalogStat',
+    sa.Column('dimension', sa.String(), nullable=False),
+    sa.Column('key', sa.String(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('dimension', 'key')
+    )
+
+    dialect = op.get_bind().dialect.name
+
+    for table, columns in counted_columns.items():
+        quoted = '"{}"'.format(table)
+        if dialect == 'postgresql':
+            op.execute(
+                f'CREATE OR REPLACE FUNCTION "{table}_stats"() RETURNS trigger AS $$ BEGIN '
+                f'IF TG_OP IN (\'UPDATE\', \'DELETE\') THEN {"; ".join(decrements(table, "OLD"))}; END IF; '
+                f'IF TG_OP IN (\'INSERT\', \'UPDATE\') THEN {"; ".join(increments(table, "NEW", stat_count))}; END IF; '
+                f'RETURN NULL; END $$ LANGUAGE plpgsql'
+            )
+            op.execute(
+                f'CREATE TRIGGER "{table}_stats" AFTER INSERT OR DELETE OR UPDATE OF {columns} ON "{table}" '
+                f'FOR EACH ROW EXECUTE PROCEDURE "{table}_stats"()'
+            )
+
+        elif dialect == 'sqlite':
+            op.execute(
+                f'CREATE TRIGGER "{table}_stats_insert" AFTER INSERT ON "{table}" BEGIN '
+                f'{"; ".join(increments(table, "new", "count"))}; END'
+            )
+            op.execute(
+                f'CREATE TRIGGER "{table}_stats_delete" AFTER DELETE ON "{table}" BEGIN '
+                f'{"; ".join(decrements(table, "old"))}; END'
+            )
+            op.execute(
+                f'CREATE TRIGGER "{table}_stats_update" AFTER UPDATE OF {columns} ON "{table}" BEGIN '
+                f'{"; ".join(decrements(table, "old") + increments(table, "new", "count"))}; END'
+            )
+
+        for dimension, key in counted[table]:
+            op.execute(
+                f'INSERT INTO "CatalogStat"(dimension, key, count) '
+                f'SELECT \'{dimension}\', {key.format(row=quoted)}, count(*) FROM "{table}" GROUP BY 2'
+            )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    for table in counted_columns:
+        if dialect == 'postgresql':
+            op.execute(f'DROP TRIGGER IF EXISTS "{table}_stats" ON "{table}"')
+            op.execute(f'DROP FUNCTION IF EXISTS "{table}_stats"()')
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER IF EXISTS "{table}_stats_{trigger}"')
+
+    op.drop_table('CatalogStat')
@@ -0,0 +1,36 @@
+"""trigram GiST indexes for nearest-first search
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+searched = [('Actor', 'name'), ('Movie', 'title')]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for table, column in searched:
+        op.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{column}_trgm_gist" ON "{table}" USING gist ({column} gist_trgm_ops)')
+        op.execute(f'DROP INDEX IF EXISTS "ix_{table}_{column}_trgm"')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for table, column in searched:
+        op.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table}_{column}_trgm" ON "{table}" USING gin ({column} gin_trgm_ops)')
+        op.execute(f'DROP INDEX IF EXISTS "ix_{table}_{column}_trgm_gist"')
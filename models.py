@@ -1,27 +1,61 @@
 import os
-from sqlalchemy import Column
-from flask_sqlalchemy import SQLAlchemy
+from itertools import chain
+from sqlalchemy import Column, event
+from sqlalchemy.sql.dml import Delete, Insert, Update
+from pool import engine_options
+from replicas import RoutingSQLAlchemy, init_replicas, record_write
 
-db = SQLAlchemy()
-database_path = os.environ['DATABASE_URL']
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+
+    The database is database_path, else the app's SQLALCHEMY_DATABASE_URI,
+    else the DATABASE_URL environment variable. No connection is opened and
+    the schema is left alone: create it with `flask db upgrade`, or
+    `flask create-db` for a throwaway database. Read replicas, when
+    configured, serve the reads of GET requests (see replicas.py).
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = app.config.get('SQLALCHEMY_DATABASE_URI') or os.environ['DATABASE_URL']
+
     app.config['SQLALCHEMY_DATABASE_URI'] = database_path
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    init_replicas(app)
+
+
+'''
+dispose_engines(app)
+    drops every pooled connection of app's primary and replica engines
+
+    For forked worker processes: connections opened before the fork would
+    otherwise be shared with the parent and the other workers. New ones are
+    opened on demand.
+'''
+def dispose_engines(app):
+    db.get_engine(app).dispose()
+    replicas = app.extensions.get('replicas')
+    if replicas is not None:
+        replicas.dispose()
 
 class Movie(db.Model):
   __tablename__ = 'Movie'
 
   id = Column(db.Integer, primary_key=True)
   title = Column(db.String)
-  release_date = Column(db.Integer)
+  release_date = Column(db.Integer, index=True)
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
+
+  __mapper_args__ = {'version_id_col': version}
+
+  required_fields = {'title': str, 'release_date': int}
+
+  actors = db.relationship('Actor', secondary='Casting', back_populates='movies', order_by='Actor.id')
 
   def __init__(self, title, release_date):
     self.title = title
@@ -31,7 +65,13 @@ class Movie(db.Model):
     return {
       'id': self.id,
       'title': self.title,
-      'release_date': self.release_date}
+      'release_date': self.release_date,
+      'version': self.version}
+
+  def format_with_cast(self):
+    movie = self.format()
+    movie['cast'] = [actor.format() for actor in self.actors]
+    return movie
 
   def update(self):
     db.session.commit()
@@ -45,8 +85,16 @@ class Actor(db.Model):
 
   id = Column(db.Integer, primary_key=True)
   name = Column(db.String)
-  age = Column(db.Integer)
+  age = Column(db.Integer, index=True)
   gender = Column (db.String)
+  version = Column(db.Integer, nullable=False, default=1, server_default='1')
+
+  __table_args__ = (db.Index('ix_Actor_gender_age', 'gender', 'age'),)
+  __mapper_args__ = {'version_id_col': version}
+
+  required_fields = {'name': str, 'age': int, 'gender': str}
+
+  movies = db.relationship('Movie', secondary='Casting', back_populates='actors', order_by='Movie.id')
 
   def __init__(self, name, age, gender):
     self.name = name
@@ -58,11 +106,132 @@ class Actor(db.Model):
       'id': self.id,
       'name': self.name,
       'age': self.age,
-      'gender': self.gender}
+      'gender': self.gender,
+      'version': self.version}
+
+  def format_with_movies(self):
+    actor = self.format()
+    actor['movies'] = [movie.format() for movie in self.movies]
+    return actor
   
   def update(self):
     db.session.commit()
 
   def delete(self):
     db.session.delete(self)
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
+
+
+class Casting(db.Model):
+  __tablename__ = 'Casting'
+
+  movie_id = Column(db.Integer, db.ForeignKey('Movie.id', ondelete='CASCADE'), primary_key=True)
+  actor_id = Column(db.Integer, db.ForeignKey('Actor.id', ondelete='CASCADE'), primary_key=True, index=True)
+
+  def __init__(self, movie_id, actor_id):
+    self.movie_id = movie_id
+    self.actor_id = actor_id
+
+  def format(self):
+    return {
+      'movie_id': self.movie_id,
+      'actor_id': self.actor_id}
+
+  def insert(self):
+    db.session.add(self)
+    db.session.commit()
+
+  def delete(self):
+    db.session.delete(self)
+    db.session.commit()
+
+
+'''
+TableVersion
+    one counter per table, bumped in the same transaction as every write
+
+    Lets readers tell whether a table changed (e.g. for ETags) by reading one
+    row instead of the table itself. Kept in the database so every worker
+    process sees the same versions.
+'''
+class TableVersion(db.Model):
+  __tablename__ = 'TableVersion'
+
+  name = Column(db.String, primary_key=True)
+  version = Column(db.Integer, nullable=False, default=0)
+
+
+'''
+CatalogStat
+    number of actors or movies sharing one value of a reported dimension,
+    e.g. ('actors_by_gender', 'female')
+
+    Kept up to date by triggers on Actor and Movie (see stats.py), so every
+    write path maintains it in its own transaction.
+'''
+class CatalogStat(db.Model):
+  __tablename__ = 'CatalogStat'
+
+  dimension = Column(db.String, primary_key=True)
+  key = Column(db.String, primary_key=True)
+  count = Column(db.Integer, nullable=False, default=0)
+
+
+def get_table_versions(*names):
+  table = TableVersion.__table__
+  rows = db.session.execute(
+    table.select().where(table.c.name.in_(names))
+  )
+  versions = dict.fromkeys(names, 0)
+  versions.update({row.name: row.version for row in rows})
+  return versions
+
+
+def bump_table_versions(session, names):
+  table = TableVersion.__table__
+  for name in sorted(names):
+    result = session.execute(
+      table.update().where(table.c.name == name).values(version=table.c.version + 1)
+    )
+    if result.rowcount == 0:
+      session.execute(table.insert().values(name=name, version=1))
+
+
+def touched_tables(session):
+  return session.info.setdefault('touched_tables', set())
+
+
+@event.listens_for(db.session, 'after_flush')
+def track_flushed_tables(session, flush_context):
+  for instance in chain(session.new, session.dirty, session.deleted):
+    touched_tables(session).add(instance.__table__.name)
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def track_executed_tables(orm_execute_state):
+  statement = orm_execute_state.statement
+  if isinstance(statement, (Insert, Update, Delete)):
+    if statement.table.name != TableVersion.__tablename__:
+      touched_tables(orm_execute_state.session).add(statement.table.name)
+
+
+@event.listens_for(db.session, 'before_commit')
+def bump_touched_tables(session):
+  session.flush()
+  names = session.info.pop('touched_tables', None)
+  if names:
+    bump_table_versions(session, names)
+    session.info['wrote'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def stick_writer_to_primary(session):
+  if session.info.pop('wrote', False):
+    session.info['sticky'] = True
+    record_write()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_touched_tables(session, previous_transaction):
+  session.info.pop('touched_tables', None)
+  session.info.pop('wrote', None)
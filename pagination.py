@@ -0,0 +1,75 @@
+import os
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from collections import namedtuple
+from flask import abort
+
+default_page_size = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+max_page_size = int(os.environ.get('MAX_PAGE_SIZE', 500))
+
+Page = namedtuple('Page', ['limit', 'after', 'with_total'])
+
+
+def encode_cursor(last_id):
+    return urlsafe_b64encode(str(last_id).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(urlsafe_b64decode(padded.encode()).decode())
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        abort(400)
+
+
+'''
+get_page(args)
+    reads the limit, after and total query parameters of a list request
+
+    Returns None when neither limit nor after is given, so the caller can
+    keep returning the whole table.
+'''
+def get_page(args):
+    if 'limit' not in args and 'after' not in args:
+        return None
+
+    try:
+        limit = int(args.get('limit', default_page_size))
+    except ValueError:
+        abort(400)
+
+    if limit < 1 or limit > max_page_size:
+        abort(400)
+
+    after = None
+    if args.get('after'):
+        after = decode_cursor(args['after'])
+
+    with_total = args.get('total', '').lower() == 'true'
+
+    return Page(limit, after, with_total)
+
+
+'''
+paginate(query, column, page)
+    applies keyset pagination to query, ordered by the unique column
+
+    Runs WHERE column > :after ORDER BY column LIMIT limit + 1, so every page
+    costs the same however deep it is. Returns the rows of the page, the
+    cursor for the next page (None on the last page) and the total row count
+    when it was asked for.
+'''
+def paginate(query, column, page):
+    total = query.count() if page.with_total else None
+
+    if page.after is not None:
+        query = query.filter(column > page.after)
+
+    rows = query.order_by(column).limit(page.limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        next_cursor = encode_cursor(getattr(rows[-1], column.key))
+
+    return rows, next_cursor, total
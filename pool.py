@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+db_pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+db_max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+db_pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+db_pool_recycle = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+db_pool_pre_ping = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+db_statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+
+'''
+PoolStats
+    counters of connection checkouts from one pool, kept on the pool
+
+    wait is the time a checkout spent inside the pool, including opening a new
+    connection when the pool had to.
+'''
+class PoolStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+
+    def record_timeout(self, wait):
+        with self._lock:
+            self.timeouts += 1
+            self.wait_seconds_total += wait
+            self.wait_seconds_max = max(self.wait_seconds_max, wait)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts" : self.checkouts,
+                "timeouts" : self.timeouts,
+                "wait_seconds_total" : self.wait_seconds_total,
+                "wait_seconds_max" : self.wait_seconds_max
+            }
+
+
+class CheckoutTimingMixin:
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        # dispose() swaps in a new pool; its engine's counts carry on
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record_timeout(time.perf_counter() - start)
+            raise
+
+        self.stats.record_checkout(time.perf_counter() - start)
+        return connection
+
+
+class InstrumentedQueuePool(CheckoutTimingMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(CheckoutTimingMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+'''
+engine_options(database_uri)
+    SQLALCHEMY_ENGINE_OPTIONS for the database, read from the environment
+
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE and
+    DB_POOL_PRE_PING size and maintain the pool. DB_STATEMENT_TIMEOUT (in
+    milliseconds, 0 to disable) caps every statement on PostgreSQL. In-memory
+    SQLite databases keep Flask-SQLAlchemy's single shared connection. Async
+    drivers (aiosqlite, asyncpg) get the asyncio flavour of the same pool.
+'''
+def engine_options(database_uri):
+    url = make_url(database_uri)
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    is_async = url.get_dialect().is_async
+
+    options = {
+        'poolclass' : InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool,
+        'pool_size' : db_pool_size,
+        'max_overflow' : db_max_overflow,
+        'pool_timeout' : db_pool_timeout,
+        'pool_recycle' : db_pool_recycle,
+        'pool_pre_ping' : db_pool_pre_ping
+    }
+
+    if url.get_backend_name() == 'sqlite':
+        # pooled connections are handed between request threads
+        options['connect_args'] = {'check_same_thread' : False}
+    elif url.get_backend_name() == 'postgresql' and db_statement_timeout > 0:
+        if is_async:
+            options['connect_args'] = {'server_settings' : {'statement_timeout' : str(db_statement_timeout)}}
+        else:
+            options['connect_args'] = {'options' : '-c statement_timeout={}'.format(db_statement_timeout)}
+
+    return options
+
+
+def pool_metrics(engine):
+    pool = engine.pool
+    metrics = getattr(pool, 'stats', PoolStats()).snapshot()
+
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            "size" : pool.size(),
+            "checked_out" : pool.checkedout(),
+            "checked_in" : pool.checkedin(),
+            "overflow" : max(pool.overflow(), 0)
+        })
+
+    return metrics
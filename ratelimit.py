@@ -0,0 +1,182 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, g
+from metrics import requests_rejected
+
+rate_limits = os.environ.get('RATE_LIMITS', '')
+rate_limit_url = os.environ.get('RATE_LIMIT_URL')
+rate_limit_max_keys = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 10000))
+
+
+'''
+parse_limits(spec)
+    reads limits written as permission=rate:burst, separated by commas
+
+    rate is in requests per second and burst, the size of the bucket,
+    defaults to rate rounded up. The permission * applies to every permission
+    not listed, and to routes that only verify the token.
+'''
+def parse_limits(spec):
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+
+        permission, _, limit = item.partition('=')
+        rate, _, burst = limit.partition(':')
+        rate = float(rate)
+        burst = float(burst) if burst else max(1, math.ceil(rate))
+        if rate <= 0 or burst < 1:
+            raise ValueError('invalid rate limit: ' + item.strip())
+
+        limits[permission.strip()] = (rate, burst)
+    return limits
+
+
+'''
+MemoryRateLimitBackend
+    token buckets held in this process
+
+    Buckets are kept for at most max_keys subjects, least recently used
+    first out; a bucket that is dropped starts full again.
+'''
+class MemoryRateLimitBackend:
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last = False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+'''
+RedisRateLimitBackend
+    token buckets shared by every worker, for any client with redis-py's
+    register_script
+
+    Each bucket is a hash updated by one Lua script, so concurrent workers
+    never both spend the last token. A bucket expires once it would have
+    refilled.
+'''
+class RedisRateLimitBackend:
+
+    script = '''
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or burst
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    '''
+
+    def __init__(self, client, prefix='casting:ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._take = client.register_script(self.script)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys = [self.prefix + key], args = [rate, burst, time.time()]))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RATE_LIMIT_URL needs the redis package: pip install redis') from None
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+
+def backend_from_env():
+    if rate_limit_url:
+        return RedisRateLimitBackend.from_url(rate_limit_url)
+    return MemoryRateLimitBackend(max_keys = rate_limit_max_keys)
+
+
+'''
+RateLimiter
+    limits how often one subject may use each permission
+
+    Every (sub, permission) pair has its own token bucket. Permissions with
+    no limit, when * has none either, are not counted at all.
+'''
+class RateLimiter:
+
+    def __init__(self, backend, limits=None):
+        self.backend = backend
+        self.limits = limits or {}
+
+    def check(self, sub, permission):
+        limit = self.limits.get(permission) or self.limits.get('*')
+        if limit is None:
+            return
+
+        wait = self.backend.take('{}|{}'.format(sub, permission or '*'), *limit)
+        if wait > 0:
+            requests_rejected.inc(reason = 'rate_limit')
+            abort(429, retry_after = math.ceil(wait))
+
+
+rate_limiter = RateLimiter(backend_from_env(), parse_limits(rate_limits))
+
+
+'''
+limit_concurrency(app, max_concurrent, retry_after)
+    answers 503 to requests beyond max_concurrent in progress in this process
+
+    Checked before any other work, so excess requests are turned away at
+    once instead of queueing for a pool connection. Clients are told to retry
+    after retry_after seconds.
+'''
+def limit_concurrency(app, max_concurrent, retry_after=1):
+    slots = threading.BoundedSemaphore(max_concurrent)
+
+    def admit():
+        if not slots.acquire(blocking = False):
+            requests_rejected.inc(reason = 'concurrency')
+            abort(503, retry_after = retry_after)
+        g.admitted = True
+
+    def release(exc):
+        if g.pop('admitted', False):
+            slots.release()
+
+    app.before_request_funcs.setdefault(None, []).insert(0, admit)
+    app.teardown_request(release)
+    return slots
@@ -0,0 +1,266 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.sql.dml import UpdateBase
+from pool import engine_options
+
+database_replica_urls = os.environ.get('DATABASE_REPLICA_URLS', '')
+replica_stickiness = float(os.environ.get('REPLICA_STICKINESS', 5))
+replica_retry_interval = float(os.environ.get('REPLICA_RETRY_INTERVAL', 30))
+replica_max_clients = int(os.environ.get('REPLICA_MAX_CLIENTS', 10000))
+replica_stickiness_url = os.environ.get('REPLICA_STICKINESS_URL')
+
+read_methods = ('GET', 'HEAD')
+
+logger = logging.getLogger(__name__)
+
+
+'''
+MemoryWriterBackend
+    clients that wrote recently, remembered in this process only
+
+    At most max_clients are kept, least recently written first out.
+'''
+class MemoryWriterBackend:
+
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self._writers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def mark(self, client, seconds):
+        with self._lock:
+            self._writers[client] = time.monotonic() + seconds
+            self._writers.move_to_end(client)
+            while len(self._writers) > self.max_clients:
+                self._writers.popitem(last = False)
+
+    def is_marked(self, client):
+        until = self._writers.get(client)
+        return until is not None and until > time.monotonic()
+
+
+'''
+RedisWriterBackend
+    clients that wrote recently, shared by every worker, for any client with
+    redis-py's get/set
+
+    Each mark is a key expiring with the stickiness window, holding its end
+    so that it is honoured even before the server expires it.
+'''
+class RedisWriterBackend:
+
+    def __init__(self, client, prefix='casting:writer:'):
+        self.client = client
+        self.prefix = prefix
+
+    def mark(self, client, seconds):
+        self.client.set(self.prefix + client, repr(time.time() + seconds), px = max(1, int(seconds * 1000)))
+
+    def is_marked(self, client):
+        until = self.client.get(self.prefix + client)
+        return until is not None and float(until) > time.time()
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('REPLICA_STICKINESS_URL needs the redis package: pip install redis') from None
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+
+def writer_backend_from_env():
+    if replica_stickiness_url:
+        return RedisWriterBackend.from_url(replica_stickiness_url)
+    return MemoryWriterBackend(max_clients = replica_max_clients)
+
+
+'''
+ReplicaSet
+    read replicas taken in turn, skipping the ones that are down
+
+    A replica is marked down when a statement or connection on it fails, and
+    is probed with SELECT 1 once retry_interval seconds have passed before it
+    is used again. Clients that wrote are remembered in writers for
+    stickiness seconds, during which their reads go to the primary, so that
+    they read their own writes however far the replicas lag. With several
+    worker processes writers must be shared (RedisWriterBackend), or a read
+    that lands on another worker than the write may be stale. When writers
+    cannot be reached every read goes to the primary.
+'''
+class ReplicaSet:
+
+    def __init__(self, engines, stickiness=5, retry_interval=30, writers=None):
+        self.engines = engines
+        self.stickiness = stickiness
+        self.retry_interval = retry_interval
+        self.writers = writers if writers is not None else MemoryWriterBackend()
+        self.reads = [0] * len(engines)
+        self._down_since = [None] * len(engines)
+        self._next = 0
+        self._lock = threading.Lock()
+
+        for engine in engines:
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    def _handle_error(self, context):
+        if context.engine in self.engines and (context.is_disconnect or context.connection is None):
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        with self._lock:
+            index = self.engines.index(engine)
+            if self._down_since[index] is None:
+                self._down_since[index] = time.monotonic()
+
+    def probe(self, engine):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            return True
+        except Exception:
+            return False
+
+    def choose(self):
+        for _ in range(len(self.engines)):
+            with self._lock:
+                index = self._next
+                self._next = (self._next + 1) % len(self.engines)
+                down_since = self._down_since[index]
+
+            if down_since is not None:
+                if time.monotonic() - down_since < self.retry_interval:
+                    continue
+                if not self.probe(self.engines[index]):
+                    with self._lock:
+                        self._down_since[index] = time.monotonic()
+                    continue
+                with self._lock:
+                    self._down_since[index] = None
+
+            with self._lock:
+                self.reads[index] += 1
+            return self.engines[index]
+
+        return None
+
+    def record_write(self, client):
+        try:
+            self.writers.mark(client, self.stickiness)
+        except Exception as e:
+            logger.warning('could not record a write for replica stickiness: %s', e)
+
+    def is_sticky(self, client):
+        try:
+            return self.writers.is_marked(client)
+        except Exception as e:
+            logger.warning('could not read replica stickiness, reading from the primary: %s', e)
+            return True
+
+    def stats(self):
+        with self._lock:
+            states = list(zip(self.engines, self._down_since, self.reads))
+        return [
+            {'url': engine.url.render_as_string(hide_password = True), 'up': down_since is None, 'reads': reads}
+            for engine, down_since, reads in states
+        ]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+'''
+init_replicas(app)
+    creates the replica engines for SQLALCHEMY_REPLICA_URIS, else the comma
+    separated DATABASE_REPLICA_URLS
+
+    Each replica gets the same pool settings as the primary. Writers are
+    remembered in Redis at REPLICA_STICKINESS_URL, else in this process.
+    Without replicas every statement goes to the primary.
+'''
+def init_replicas(app):
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS')
+    if uris is None:
+        uris = [uri.strip() for uri in database_replica_urls.split(',') if uri.strip()]
+
+    if not uris:
+        app.extensions.pop('replicas', None)
+        return None
+
+    replicas = app.extensions['replicas'] = ReplicaSet(
+        [create_engine(uri, **engine_options(uri)) for uri in uris],
+        stickiness = app.config.get('REPLICA_STICKINESS', replica_stickiness),
+        retry_interval = app.config.get('REPLICA_RETRY_INTERVAL', replica_retry_interval),
+        writers = app.config.get('REPLICA_WRITER_BACKEND') or writer_backend_from_env()
+    )
+    return replicas
+
+
+def request_client():
+    authorization = request.headers.get('Authorization')
+    if authorization:
+        return hashlib.sha256(authorization.encode()).hexdigest()
+    return request.remote_addr
+
+
+'''
+record_write()
+    makes the current client read from the primary for the stickiness window
+'''
+def record_write():
+    if has_request_context():
+        replicas = current_app.extensions.get('replicas')
+        if replicas is not None:
+            replicas.record_write(request_client())
+
+
+'''
+RoutingSession
+    sends the reads of GET and HEAD requests to a replica
+
+    Everything else goes to the primary: writes, statements of any other
+    request or outside one, reads of a client within its stickiness window,
+    and reads in a session that has already written. Falls back to the
+    primary when every replica is down. Whether the client is sticky is
+    looked up once per session, and a session keeps to the replica it first
+    read from, so that all its reads see the same snapshot.
+'''
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replicas = self.app.extensions.get('replicas')
+        if replicas is not None and self.reads_from_replica(replicas, clause):
+            engine = self.info.get('replica') or replicas.choose()
+            if engine is not None:
+                self.info['replica'] = engine
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def reads_from_replica(self, replicas, clause):
+        if not (
+            has_request_context()
+            and request.method in read_methods
+            and not isinstance(clause, UpdateBase)
+            and not self.info.get('touched_tables')
+            and not self.info.get('wrote')
+        ):
+            return False
+        # asked once per session rather than per statement: with a shared
+        # backend it is a round trip
+        if 'sticky' not in self.info:
+            self.info['sticky'] = replicas.is_sticky(request_client())
+        return not self.info['sticky']
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_ = RoutingSession, db = self, **options)
@@ -0,0 +1,173 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import Response, g, make_response, request
+from conditional import request_models, table_etag
+from metrics import cache_lookups
+
+response_cache_url = os.environ.get('RESPONSE_CACHE_URL')
+response_cache_max_bytes = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+response_cache_ttl = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+
+'''
+MemoryCacheBackend
+    in-process LRU store of encoded responses, bounded by their total size
+'''
+class MemoryCacheBackend:
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last = False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+'''
+RedisCacheBackend
+    store shared by every worker, for any client with redis-py's get/set/delete
+
+    Entries expire after ttl seconds; eviction beyond that is left to the
+    server's maxmemory policy.
+'''
+class RedisCacheBackend:
+
+    def __init__(self, client, ttl=300, prefix='casting:response:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex = self.ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_URL needs the redis package: pip install redis') from None
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+
+def backend_from_env():
+    if response_cache_url:
+        return RedisCacheBackend.from_url(response_cache_url, ttl = response_cache_ttl)
+    return MemoryCacheBackend(max_bytes = response_cache_max_bytes)
+
+
+'''
+ResponseCache
+    caches the encoded body of read responses
+
+    Keys are made of the route, the sorted query parameters, the permission
+    scope and the ETag of the tables the response was read from. A write bumps
+    the table version, so entries for the old data are never served again and
+    age out of the backend. Hits and misses are counted in cache_lookups_total.
+'''
+class ResponseCache:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(scope, etag):
+        query = urlencode(sorted(request.args.items(multi = True)))
+        return '{}?{}|{}|{}'.format(request.path, query, scope, etag)
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            cache_lookups.inc(cache = 'response', result = 'miss')
+            return None
+
+        self.hits += 1
+        cache_lookups.inc(cache = 'response', result = 'hit')
+        mimetype, _, body = value.partition(b'\n')
+        return Response(body, mimetype = mimetype.decode())
+
+    def set(self, key, response):
+        self.backend.set(key, response.mimetype.encode() + b'\n' + response.get_data())
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : self.hits / lookups if lookups else 0.0
+        }
+
+
+response_cache = ResponseCache(backend_from_env())
+
+
+'''
+cached_response(scope, *models, embeds)
+    serves a read endpoint from response_cache
+
+    Only complete 200 responses are stored; streamed responses pass through.
+    Reuses the ETag computed by conditional_get when it wraps this decorator.
+'''
+def cached_response(scope, *models, embeds=None):
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = g.get('table_etag') or table_etag(*request_models(models, embeds))
+            key = response_cache.key(scope, etag)
+
+            cached = response_cache.get(key)
+            if cached is not None:
+                return cached
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, response)
+            return response
+        return wrapper
+    return cached_response_decorator
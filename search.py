@@ -0,0 +1,138 @@
+import os
+import re
+from flask import abort
+from sqlalchemy import DDL, Column, Float, Integer, MetaData, Table, event, literal_column
+from models import db, Actor, Movie
+from pagination import max_page_size
+
+search_default_limit = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+
+# column searched for each model
+search_columns = {
+    Actor: Actor.name,
+    Movie: Movie.title
+}
+
+
+def search_table_name(model):
+    return model.__tablename__ + 'Search'
+
+
+'''
+Search indexes
+
+PostgreSQL gets a trigram GiST index on each searched column, which serves
+ILIKE '%term%' lookups and can return rows in order of trigram distance
+(<->), so a search reads only as many rows as its limit. SQLite gets an
+external-content FTS5 table per model, kept in sync by triggers. Both are
+created alongside the tables by create_all here, and by the 0004 and 0007
+migrations for migrated databases.
+'''
+def search_ddl(model):
+    table = model.__tablename__
+    column = search_columns[model].key
+    search_table = search_table_name(model)
+
+    postgresql = [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        f'CREATE INDEX IF NOT EXISTS "ix_{table}_{column}_trgm_gist" ON "{table}" USING gist ({column} gist_trgm_ops)'
+    ]
+    sqlite = [
+        f'CREATE VIRTUAL TABLE "{search_table}" USING fts5({column}, content=\'{table}\', content_rowid=\'id\', prefix=\'2 3\')',
+        f'CREATE TRIGGER "{table}_search_insert" AFTER INSERT ON "{table}" BEGIN '
+        f'INSERT INTO "{search_table}"(rowid, {column}) VALUES (new.id, new.{column}); END',
+        f'CREATE TRIGGER "{table}_search_delete" AFTER DELETE ON "{table}" BEGIN '
+        f'INSERT INTO "{search_table}"("{search_table}", rowid, {column}) VALUES (\'delete\', old.id, old.{column}); END',
+        f'CREATE TRIGGER "{table}_search_update" AFTER UPDATE OF {column} ON "{table}" BEGIN '
+        f'INSERT INTO "{search_table}"("{search_table}", rowid, {column}) VALUES (\'delete\', old.id, old.{column}); '
+        f'INSERT INTO "{search_table}"(rowid, {column}) VALUES (new.id, new.{column}); END',
+    ]
+    return postgresql, sqlite
+
+
+for model in search_columns:
+    postgresql, sqlite = search_ddl(model)
+    for statement in postgresql:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+    for statement in sqlite:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(
+        model.__table__,
+        'before_drop',
+        DDL(f'DROP TABLE IF EXISTS "{search_table_name(model)}"').execute_if(dialect='sqlite')
+    )
+
+
+'''
+get_search(args)
+    reads the q and limit parameters of a search request
+
+    Returns None when q is not given. Search results are ranked, so they
+    cannot be combined with an after cursor.
+'''
+def get_search(args):
+    if 'q' not in args:
+        return None
+
+    if 'after' in args:
+        abort(400)
+
+    try:
+        limit = int(args.get('limit', search_default_limit))
+    except ValueError:
+        abort(400)
+
+    if limit < 1 or limit > max_page_size:
+        abort(400)
+
+    return args['q'].strip(), limit
+
+
+def fts_match(q):
+    terms = re.findall(r'\w+', q)
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+
+'''
+search(query, model, q, limit)
+    narrows query to the limit best matches for q, best first
+
+    On SQLite every word of q must prefix-match a word of the searched column,
+    ranked by bm25. Elsewhere the column must contain q, ranked by trigram
+    distance.
+'''
+def search(query, model, q, limit):
+    if db.engine.dialect.name == 'sqlite':
+        match = fts_match(q)
+        if not match:
+            return []
+
+        search_table = Table(
+            search_table_name(model), MetaData(),
+            Column('rowid', Integer), Column('rank')
+        )
+        return query.join(search_table, search_table.c.rowid == model.id) \
+            .filter(literal_column('"{}"'.format(search_table.name)).op('MATCH')(match)) \
+            .order_by(search_table.c.rank, model.id) \
+            .limit(limit).all()
+
+    if not q:
+        return []
+
+    return trigram_search(query, model, q).limit(limit).all()
+
+
+'''
+trigram_search(query, model, q)
+    query narrowed to rows whose searched column contains q, nearest first
+
+    Ordering by the <-> distance operator lets the trigram GiST index return
+    rows nearest first, so with a limit only that many matches are read
+    rather than every match being sorted; this holds for one and two letter
+    queries too, which match most of the table.
+'''
+def trigram_search(query, model, q):
+    column = search_columns[model]
+    pattern = '%' + q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+    return query.filter(column.ilike(pattern)) \
+        .order_by(column.op('<->', return_type=Float)(q), model.id)
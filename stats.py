@@ -0,0 +1,146 @@
+from sqlalchemy import DDL, event, text
+from models import db, touched_tables, Actor, CatalogStat, Movie
+
+# dimensions counted for each model: (dimension, columns, SQL of the row's key)
+# where {row} stands for the row being counted
+stat_dimensions = {
+    Actor: [
+        ('actors_by_gender', ('gender',), "COALESCE({row}.gender, 'unknown')"),
+        ('actors_by_age', ('age',), "COALESCE(CAST({row}.age / 10 * 10 AS TEXT), 'unknown')")
+    ],
+    Movie: [
+        ('movies_by_release_year', ('release_date',), "COALESCE(CAST({row}.release_date AS TEXT), 'unknown')")
+    ]
+}
+
+stat_table = CatalogStat.__tablename__
+
+
+def increment_sql(dimension, key, count_column):
+    return (
+        f'INSERT INTO "{stat_table}"(dimension, key, count) VALUES (\'{dimension}\', {key}, 1) '
+        f'ON CONFLICT (dimension, key) DO UPDATE SET count = {count_column} + 1'
+    )
+
+
+def decrement_sql(dimension, key):
+    return f'UPDATE "{stat_table}" SET count = count - 1 WHERE dimension = \'{dimension}\' AND key = {key}'
+
+
+'''
+Statistics triggers
+
+Every insert on Actor or Movie adds one to the count of the row's key in each
+of its dimensions, every delete takes one away, and an update of a counted
+column moves the row from its old keys to its new ones. SQLite gets one
+trigger per event; PostgreSQL one plpgsql function per table. Both are
+created alongside the tables by create_all here, and by the 0006 migration
+for migrated databases.
+'''
+def stats_ddl(model):
+    table = model.__tablename__
+    dimensions = stat_dimensions[model]
+    columns = ', '.join(dict.fromkeys(column for _, dimension_columns, _ in dimensions for column in dimension_columns))
+
+    increments = [increment_sql(dimension, key.format(row = 'new'), 'count') for dimension, _, key in dimensions]
+    decrements = [decrement_sql(dimension, key.format(row = 'old')) for dimension, _, key in dimensions]
+    sqlite = [
+        f'CREATE TRIGGER "{table}_stats_insert" AFTER INSERT ON "{table}" BEGIN {"; ".join(increments)}; END',
+        f'CREATE TRIGGER "{table}_stats_delete" AFTER DELETE ON "{table}" BEGIN {"; ".join(decrements)}; END',
+        f'CREATE TRIGGER "{table}_stats_update" AFTER UPDATE OF {columns} ON "{table}" BEGIN '
+        f'{"; ".join(decrements + increments)}; END'
+    ]
+
+    increments = [increment_sql(dimension, key.format(row = 'NEW'), f'"{stat_table}".count') for dimension, _, key in dimensions]
+    decrements = [decrement_sql(dimension, key.format(row = 'OLD')) for dimension, _, key in dimensions]
+    postgresql = [
+        f'CREATE OR REPLACE FUNCTION "{table}_stats"() RETURNS trigger AS $$ BEGIN '
+        f'IF TG_OP IN (\'UPDATE\', \'DELETE\') THEN {"; ".join(decrements)}; END IF; '
+        f'IF TG_OP IN (\'INSERT\', \'UPDATE\') THEN {"; ".join(increments)}; END IF; '
+        f'RETURN NULL; END $$ LANGUAGE plpgsql',
+        f'CREATE TRIGGER "{table}_stats" AFTER INSERT OR DELETE OR UPDATE OF {columns} ON "{table}" '
+        f'FOR EACH ROW EXECUTE PROCEDURE "{table}_stats"()'
+    ]
+    return postgresql, sqlite
+
+
+for model in stat_dimensions:
+    postgresql, sqlite = stats_ddl(model)
+    for statement in postgresql:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+    for statement in sqlite:
+        event.listen(model.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+    event.listen(
+        model.__table__,
+        'after_drop',
+        DDL(f'DROP FUNCTION IF EXISTS "{model.__tablename__}_stats"()').execute_if(dialect='postgresql')
+    )
+
+
+def rebuild_sql():
+    statements = [f'DELETE FROM "{stat_table}"']
+    for model, dimensions in stat_dimensions.items():
+        table = '"{}"'.format(model.__tablename__)
+        for dimension, _, key in dimensions:
+            statements.append(
+                f'INSERT INTO "{stat_table}"(dimension, key, count) '
+                f'SELECT \'{dimension}\', {key.format(row = table)}, count(*) FROM {table} GROUP BY 2'
+            )
+    return statements
+
+
+'''
+rebuild_stats()
+    recounts every dimension from the Actor and Movie tables
+
+    For repair, e.g. after rows were changed with the triggers missing. Runs
+    in the session transaction; the caller commits, which bumps CatalogStat's
+    version so that GET /stats responses cached by ETag are not served again.
+'''
+def rebuild_stats():
+    for statement in rebuild_sql():
+        db.session.execute(text(statement))
+    touched_tables(db.session).add(stat_table)
+
+
+def age_range(key):
+    if key == 'unknown':
+        return key
+    return '{}-{}'.format(key, int(key) + 9)
+
+
+'''
+catalog_stats(actors, movies)
+    the counts of GET /stats, read from CatalogStat
+
+    One indexed read of at most a row per distinct value, however many
+    actors and movies there are. actors and movies say which halves the
+    caller may see.
+'''
+def catalog_stats(actors=True, movies=True):
+    dimensions = [
+        dimension
+        for model, include in ((Actor, actors), (Movie, movies)) if include
+        for dimension, _, _ in stat_dimensions[model]
+    ]
+    rows = db.session.query(CatalogStat).filter(
+        CatalogStat.dimension.in_(dimensions), CatalogStat.count > 0
+    )
+
+    counts = {dimension: {} for dimension in dimensions}
+    for row in rows:
+        counts[row.dimension][row.key] = row.count
+
+    body = {}
+    if actors:
+        body['actors'] = {
+            'total' : sum(counts['actors_by_gender'].values()),
+            'by_gender' : counts['actors_by_gender'],
+            'by_age' : {age_range(key): count for key, count in counts['actors_by_age'].items()}
+        }
+    if movies:
+        body['movies'] = {
+            'total' : sum(counts['movies_by_release_year'].values()),
+            'by_release_year' : counts['movies_by_release_year']
+        }
+    return body
@@ -0,0 +1,99 @@
+import os
+from flask import Response, abort, json, stream_with_context
+from serialization import jsonify_format, rows_placeholder
+
+stream_batch_size = int(os.environ.get('STREAM_BATCH_SIZE', 1000))
+
+stream_formats = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+'''
+get_stream_format(args)
+    reads the stream query parameter of a list request
+
+    Returns None when streaming was not asked for, otherwise 'json' or
+    'ndjson'. stream=true is an alias for stream=json.
+'''
+def get_stream_format(args):
+    stream = args.get('stream')
+    if stream is None:
+        return None
+
+    stream = stream.lower()
+    if stream == 'true':
+        stream = 'json'
+
+    if stream not in stream_formats:
+        abort(400)
+
+    return stream
+
+
+def iter_rows(query, column, batch_size=None):
+    return query.order_by(column).yield_per(batch_size or stream_batch_size)
+
+
+def format_row(row):
+    return row.format()
+
+
+'''
+json_array_chunks(key, rows, format_row)
+    the chunks of jsonify({'success': True, key: [format_row(row) for row in
+    rows]}), byte for byte: same key order, separators and indentation
+
+    The envelope is dumped around a placeholder row and split there, so the
+    rows are written between its two halves as they arrive.
+'''
+def json_array_chunks(key, rows, format_row=format_row):
+    indent, separators = jsonify_format()
+    envelope = json.dumps({'success': True, key: [rows_placeholder]}, indent=indent, separators=separators)
+    head, tail = envelope.split(json.dumps(rows_placeholder), 1)
+    # the whitespace before a row: a newline and the row's indentation when
+    # indented, nothing when compact
+    gap = head[len(head.rstrip()):]
+
+    def dump(row):
+        return json.dumps(format_row(row), indent=indent, separators=separators).replace('\n', gap or '\n')
+
+    first = True
+    for row in rows:
+        if first:
+            first = False
+            yield head + dump(row)
+        else:
+            yield separators[0] + gap + dump(row)
+
+    if first:
+        yield head.rstrip() + tail.lstrip() + '\n'
+    else:
+        yield tail + '\n'
+
+
+def ndjson_chunks(rows, format_row=format_row):
+    for row in rows:
+        yield json.dumps(format_row(row), separators=(',', ':')) + '\n'
+
+
+'''
+stream_response(query, column, key, stream, format_row)
+    streams every row of query ordered by column without building the list
+
+    Rows are pulled from the database in batches of STREAM_BATCH_SIZE using a
+    server-side cursor where the driver supports one, and written out one by
+    one, so memory use does not grow with the table. The json format wraps the
+    rows as {"success": true, key: [...]}, ndjson writes one row per line.
+    Each row is written as format_row(row), row.format() by default.
+'''
+def stream_response(query, column, key, stream, format_row=format_row):
+    rows = iter_rows(query, column)
+
+    if stream == 'ndjson':
+        chunks = ndjson_chunks(rows, format_row)
+    else:
+        chunks = json_array_chunks(key, rows, format_row)
+
+    return Response(stream_with_context(chunks), mimetype = stream_formats[stream])
@@ -0,0 +1,277 @@
+import click
+import csv
+import io
+import json
+import os
+import time
+from contextlib import nullcontext
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DBAPIError
+from bulk import validate_record
+from models import db, touched_tables
+
+transfer_chunk_size = int(os.environ.get('TRANSFER_CHUNK_SIZE', 10000))
+
+transfer_formats = ('csv', 'ndjson')
+
+
+class TransferError(Exception):
+    def __init__(self, imported, message):
+        self.imported = imported
+        self.message = message
+
+
+'''
+get_transfer_format(path, format)
+    the format of a data file: format when given, else csv for .csv files and
+    ndjson for anything else, including - (stdin or stdout)
+'''
+def get_transfer_format(path, format=None):
+    if format is not None:
+        return format
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def open_data(path, mode):
+    if path == '-':
+        return nullcontext(click.get_text_stream('stdin' if mode == 'r' else 'stdout', encoding='utf-8'))
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+'''
+TransferReport
+    progress and throughput of an import or export, written to stderr
+
+    progress(count) prints the running count and rate at most every interval
+    seconds; finish(count) prints the totals.
+'''
+class TransferReport:
+
+    def __init__(self, action, resource, interval=5):
+        self.action = action
+        self.resource = resource
+        self.interval = interval
+        self.start = self.reported = time.perf_counter()
+
+    def rate(self, count):
+        return count / max(time.perf_counter() - self.start, 1e-9)
+
+    def progress(self, count):
+        if time.perf_counter() - self.reported >= self.interval:
+            self.reported = time.perf_counter()
+            click.echo('{} {} {} ({:.0f} rows/s)'.format(self.action, count, self.resource, self.rate(count)), err = True)
+
+    def finish(self, count):
+        click.echo('{} {} {} in {:.1f}s ({:.0f} rows/s)'.format(
+            self.action, count, self.resource, time.perf_counter() - self.start, self.rate(count)
+        ), err = True)
+
+
+def export_columns(model):
+    return list(model.__table__.columns)
+
+
+'''
+export_records(model, out, format, chunk_size, progress)
+    writes every row of model's table to out, ordered by id, and returns how
+    many were written
+
+    Rows are fetched chunk_size at a time through a server-side cursor where
+    the driver has one and written out as they arrive, so memory use does not
+    grow with the table. csv starts with a header of the column names, ndjson
+    writes one object per line. progress(count) is called after each chunk.
+'''
+def export_records(model, out, format, chunk_size=None, progress=None):
+    columns = export_columns(model)
+    names = [column.name for column in columns]
+    result = db.session.execute(
+        select(*columns).order_by(model.__table__.c.id),
+        execution_options = {'stream_results': True}
+    )
+
+    if format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(names)
+        write_rows = writer.writerows
+    else:
+        def write_rows(rows):
+            out.write(''.join(json.dumps(dict(zip(names, row))) + '\n' for row in rows))
+
+    count = 0
+    for rows in result.partitions(chunk_size or transfer_chunk_size):
+        write_rows(rows)
+        count += len(rows)
+        if progress is not None:
+            progress(count)
+    return count
+
+
+'''
+iter_import_records(model, lines, format)
+    yields (line, record, error) for every record of a data file
+
+    CSV values are read as strings and converted to the types of
+    model.required_fields; an empty value is a missing one. id is optional.
+'''
+def iter_import_records(model, lines, format):
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        for values in reader:
+            record = {field: value for field, value in values.items() if field and value not in (None, '')}
+            yield reader.line_num, record, convert_fields(model, record)
+        return
+
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line), None
+        except ValueError:
+            yield line_num, None, 'malformed JSON'
+
+
+def convert_fields(model, record):
+    field_types = dict(model.required_fields, id=int)
+    for field in field_types.keys() & record.keys():
+        try:
+            record[field] = field_types[field](record[field])
+        except ValueError:
+            return 'invalid value for field: ' + field
+    return None
+
+
+def import_row(model, record):
+    row = {field: record[field] for field in model.required_fields}
+    if record.get('id') is not None:
+        if not isinstance(record['id'], int) or isinstance(record['id'], bool):
+            return None, 'invalid value for field: id'
+        row['id'] = record['id']
+    return row, None
+
+
+def upsert_statement(model):
+    table = model.__table__
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(table)
+    return statement.on_conflict_do_update(
+        index_elements = [table.c.id],
+        set_ = dict(
+            {field: statement.excluded[field] for field in model.required_fields},
+            version = table.c.version + 1
+        )
+    )
+
+
+def insert_rows(model, rows, upsert):
+    if upsert and 'id' in rows[0]:
+        db.session.execute(upsert_statement(model), rows)
+    else:
+        db.session.execute(model.__table__.insert(), rows)
+
+
+def copy_rows(model, rows, upsert):
+    table = model.__tablename__
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([row[column] for column in columns] for row in rows)
+    buffer.seek(0)
+
+    # rows never hold NULLs (every field is required), but an unquoted empty
+    # CSV value is read as NULL unless told otherwise
+    column_list = ', '.join(columns)
+    text_columns = ', '.join(field for field, field_type in model.required_fields.items() if field_type is str)
+    options = f'FORMAT csv, FORCE_NOT_NULL ({text_columns})'
+    cursor = db.session.connection().connection.cursor()
+    try:
+        if upsert and 'id' in columns:
+            assignments = ', '.join('{0} = EXCLUDED.{0}'.format(field) for field in model.required_fields)
+            cursor.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS "{table}_import" (LIKE "{table}" INCLUDING DEFAULTS) ON COMMIT DELETE ROWS')
+            cursor.copy_expert(f'COPY "{table}_import"({column_list}) FROM STDIN WITH ({options})', buffer)
+            cursor.execute(
+                f'INSERT INTO "{table}"({column_list}) SELECT {column_list} FROM "{table}_import" '
+                f'ON CONFLICT (id) DO UPDATE SET {assignments}, version = "{table}".version + 1'
+            )
+        else:
+            cursor.copy_expert(f'COPY "{table}"({column_list}) FROM STDIN WITH ({options})', buffer)
+    finally:
+        cursor.close()
+    touched_tables(db.session).add(table)
+
+
+def reset_id_sequence(model):
+    table = model.__tablename__
+    db.session.execute(text(
+        f'SELECT setval(pg_get_serial_sequence(\'"{table}"\', \'id\'), COALESCE(MAX(id), 0) + 1, false) FROM "{table}"'
+    ))
+
+
+'''
+import_records(model, lines, format, upsert, chunk_size, progress)
+    loads every valid record of a data file into model's table and returns
+    (imported, errors)
+
+    Records are read and loaded chunk_size at a time, with COPY on PostgreSQL
+    and an executemany INSERT elsewhere, and each chunk is committed, so
+    memory use does not grow with the file and an interrupted import can be
+    run again with upsert. Records with an id keep it; with upsert, one that
+    already exists is updated instead, and of the records of a chunk sharing
+    an id the last one wins. Invalid records are skipped and reported as
+    {'line', 'message'} errors. progress(imported) is called after each
+    chunk. A chunk the database rejects is rolled back and raised as a
+    TransferError; the chunks before it stay committed.
+'''
+def import_records(model, lines, format, upsert=False, chunk_size=None, progress=None):
+    chunk_size = chunk_size or transfer_chunk_size
+    postgresql_load = db.engine.dialect.name == 'postgresql'
+    load = copy_rows if postgresql_load else insert_rows
+    imported = 0
+    errors = []
+    explicit_ids = False
+    chunks = {True: [], False: []}
+
+    def flush():
+        nonlocal imported
+        if upsert and chunks[True]:
+            chunks[True][:] = {row['id']: row for row in chunks[True]}.values()
+
+        count = 0
+        try:
+            for rows in chunks.values():
+                if rows:
+                    load(model, rows, upsert)
+                    count += len(rows)
+                    rows.clear()
+            db.session.commit()
+        except (DBAPIError, db.engine.dialect.dbapi.Error) as e:
+            db.session.rollback()
+            raise TransferError(imported, str(getattr(e, 'orig', e)).strip())
+
+        imported += count
+        if progress is not None:
+            progress(imported)
+
+    try:
+        for line, record, error in iter_import_records(model, lines, format):
+            if error is None:
+                error = validate_record(model, record)
+            if error is None:
+                row, error = import_row(model, record)
+            if error is not None:
+                errors.append({'line': line, 'message': error})
+                continue
+
+            explicit_ids = explicit_ids or 'id' in row
+            chunks['id' in row].append(row)
+            if len(chunks[True]) + len(chunks[False]) >= chunk_size:
+                flush()
+
+        if chunks[True] or chunks[False]:
+            flush()
+    finally:
+        # ids loaded explicitly bypass the sequence, even when a later chunk failed
+        if explicit_ids and postgresql_load:
+            reset_id_sequence(model)
+            db.session.commit()
+
+    return imported, errors
@@ -0,0 +1,103 @@
+from flask import abort, request
+from sqlalchemy import select
+from models import db, touched_tables, Casting
+
+
+'''
+get_if_match()
+    reads the record versions a write is conditional on from If-Match
+
+    Versions are sent as strong ETags holding the record's version field,
+    e.g. If-Match: "3". Returns None when the write is unconditional (no
+    If-Match, or *). A header naming no version can never match.
+'''
+def get_if_match():
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+
+    return [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+
+
+def update_statement(model, record_id, values, versions=None):
+    table = model.__table__
+    statement = table.update().where(table.c.id == record_id)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    return statement.values(version = table.c.version + 1, **values)
+
+
+def delete_statement(model, record_id, versions=None):
+    table = model.__table__
+    statement = table.delete().where(table.c.id == record_id)
+    if versions is not None:
+        statement = statement.where(table.c.version.in_(versions))
+    return statement
+
+
+def exists_statement(model, record_id):
+    return select(model.__table__.c.id).where(model.__table__.c.id == record_id)
+
+
+'''
+update_record(model, record_id, values, versions)
+    updates one record with a single UPDATE ... RETURNING and returns its row
+
+    The version is incremented by the same statement, and with versions the
+    UPDATE only matches a record at one of them. An empty result is a 404, or
+    a 412 when the record exists at another version. Dialects without
+    RETURNING (SQLite) read the row back in the same transaction instead.
+'''
+def update_record(model, record_id, values, versions=None):
+    table = model.__table__
+    statement = update_statement(model, record_id, values, versions)
+
+    if db.engine.dialect.full_returning:
+        row = db.session.execute(statement.returning(*table.columns)).first()
+    elif db.session.execute(statement).rowcount:
+        row = db.session.execute(table.select().where(table.c.id == record_id)).first()
+    else:
+        row = None
+
+    if row is None:
+        abort_missing(model, record_id, versions)
+    return row
+
+
+'''
+delete_record(model, record_id, versions, *columns)
+    deletes one record with a single DELETE ... RETURNING columns
+
+    Errors as update_record. The record's castings go with it: through the
+    ON DELETE CASCADE of their foreign keys, or explicitly on SQLite, where
+    foreign keys are not enforced. Dialects without RETURNING read the
+    columns first in the same transaction.
+'''
+def delete_record(model, record_id, versions, *columns):
+    statement = delete_statement(model, record_id, versions)
+    touched_tables(db.session).add(Casting.__tablename__)
+
+    if db.engine.dialect.full_returning:
+        row = db.session.execute(statement.returning(*columns)).first()
+    else:
+        row = db.session.execute(select(*columns).where(model.__table__.c.id == record_id)).first()
+        if row is not None and db.session.execute(statement).rowcount:
+            db.session.execute(casting_delete_statement(model, record_id))
+        else:
+            row = None
+
+    if row is None:
+        abort_missing(model, record_id, versions)
+    return row
+
+
+def casting_delete_statement(model, record_id):
+    table = Casting.__table__
+    column = table.c.actor_id if model.__tablename__ == 'Actor' else table.c.movie_id
+    return table.delete().where(column == record_id)
+
+
+def abort_missing(model, record_id, versions):
+    if versions is not None and db.session.execute(exists_statement(model, record_id)).first() is not None:
+        abort(412)
+    abort(404)